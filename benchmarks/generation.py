@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+
+# generation.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+
+"""Benchmark text-to-image and image-to-image generation on a tiny model.
+
+Builds a Stable Diffusion pipeline with random weights and a made-up
+tokenizer, so nothing is downloaded, and runs the generation jobs of the
+source tree on it for every combination of the given sizes, step counts,
+numbers of images, schedulers and inference backends. Each case runs in a
+fresh process on the CPU and reports:
+
+    load_s                 loading the model components
+    time_to_first_step_s   from starting the job until the first step ended
+    step_s                 median time of one denoising step
+    vae_decode_s           mean time to decode one image
+    peak_rss_mib           peak resident memory of the process
+    images_per_minute      images generated per minute, without loading
+
+The results are printed as JSON. The tiny model is far from the real one
+in absolute numbers, but changes to the generation code show up in the
+relative timings.
+"""
+
+import argparse
+import importlib
+import importlib.util
+import itertools
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TEXT_TO_IMAGE_SCHEDULERS = ["PNDMScheduler",
+                            "EulerAncestralDiscreteScheduler",
+                            "DPMSolverMultistepScheduler"]
+
+STRENGTH = 0.75
+
+PROMPT = "a benchmark"
+
+
+class _Recorder:
+    """Stands in for the pipe of the inference worker and timestamps messages."""
+
+    def __init__(self) -> None:
+        self.messages: List[Tuple[float, Tuple]] = []
+
+    def send(self, msg: Tuple) -> None:
+        self.messages.append((time.perf_counter(), msg))
+
+
+# pylint: disable-next=too-many-locals
+def build_tiny_model(path: str) -> None:
+    # pylint: disable=import-outside-toplevel
+    import torch
+    from diffusers import (AutoencoderKL, PNDMScheduler,
+                           StableDiffusionPipeline, UNet2DConditionModel)
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+    from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+    torch.manual_seed(0)
+
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=2,
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32
+    )
+    vae = AutoencoderKL(
+        block_out_channels=[32, 64],
+        in_channels=3,
+        out_channels=3,
+        down_block_types=["DownEncoderBlock2D", "DownEncoderBlock2D"],
+        up_block_types=["UpDecoderBlock2D", "UpDecoderBlock2D"],
+        latent_channels=4
+    )
+    text_encoder = CLIPTextModel(CLIPTextConfig(bos_token_id=0,
+                                                eos_token_id=2,
+                                                hidden_size=32,
+                                                intermediate_size=37,
+                                                layer_norm_eps=1e-05,
+                                                num_attention_heads=4,
+                                                num_hidden_layers=5,
+                                                pad_token_id=1,
+                                                vocab_size=1000))
+
+    # Byte-level vocabulary without any merges, every character is a token
+    tokenizer_dir = path + "_tokenizer"
+    os.makedirs(tokenizer_dir, exist_ok=True)
+
+    characters = list(bytes_to_unicode().values())
+    tokens = (characters + [character + "</w>" for character in characters]
+              + ["<|startoftext|>", "<|endoftext|>"])
+
+    with open(os.path.join(tokenizer_dir, "vocab.json"), "w",
+              encoding="utf-8") as vocab_file:
+        json.dump({token: index for index, token in enumerate(tokens)}, vocab_file)
+
+    with open(os.path.join(tokenizer_dir, "merges.txt"), "w",
+              encoding="utf-8") as merges_file:
+        merges_file.write("#version: 0.2\n")
+
+    tokenizer = CLIPTokenizer(os.path.join(tokenizer_dir, "vocab.json"),
+                              os.path.join(tokenizer_dir, "merges.txt"))
+
+    pipeline = StableDiffusionPipeline(vae=vae,
+                                       text_encoder=text_encoder,
+                                       tokenizer=tokenizer,
+                                       unet=unet,
+                                       scheduler=PNDMScheduler(skip_prk_steps=True),
+                                       safety_checker=None,
+                                       feature_extractor=None,
+                                       requires_safety_checker=False)
+    pipeline.save_pretrained(path)
+
+
+def load_package(source_dir: str) -> None:
+    """Import the source tree as the imagery package."""
+    spec = importlib.util.spec_from_file_location(
+        "imagery",
+        os.path.join(source_dir, "__init__.py"),
+        submodule_search_locations=[source_dir]
+    )
+    module = importlib.util.module_from_spec(spec)  # type: ignore
+    sys.modules["imagery"] = module
+    spec.loader.exec_module(module)  # type: ignore
+
+
+def _stage_times(messages: List[Tuple[float, Tuple]], stage: str) -> List[float]:
+    """Durations of stage as reported by the job in its metrics messages."""
+    return [msg[2] for _timestamp, msg in messages
+            if msg[0] == "metrics" and msg[1] == stage]
+
+
+def _apply_settings(values: Dict) -> None:
+    # pylint: disable-next=import-outside-toplevel
+    from gi.repository import GLib
+
+    settings = importlib.import_module("imagery.settings_manager").settings
+
+    for key, value in values.items():
+        if isinstance(value, bool):
+            variant_type = "b"
+        elif isinstance(value, str):
+            variant_type = "s"
+        else:
+            variant_type = "i"
+
+        settings.set_value(key, GLib.Variant(variant_type, value))
+
+
+# pylint: disable-next=too-many-locals
+def run_case(case: Dict, model_dir: str, work_dir: str) -> Dict:
+    """Run one case, with the settings of case["settings"] if it has any.
+
+    Cases may also give a "prompt" and a "seed". The paths of the images
+    are part of the result, they live as long as the work directory.
+    """
+    # pylint: disable=import-outside-toplevel
+    from diffusers import StableDiffusionImg2ImgPipeline, StableDiffusionPipeline
+    from PIL import Image
+
+    settings = dict(case.get("settings", {}))
+
+    # The tiny model comes without a safety checker
+    if not os.path.isdir(os.path.join(model_dir, "safety_checker")):
+        settings["allow-nsfw"] = True
+
+    _apply_settings(settings)
+
+    model_registry = importlib.import_module("imagery.model_registry").model_registry
+    model_registry.set_model_id(model_dir)
+
+    if case["mode"] == "text_to_image":
+        runner = importlib.import_module("imagery.text_to_image_runner")
+        job_module = importlib.import_module("imagery.text_to_image_job")
+        pipeline_class = StableDiffusionPipeline
+
+        job = runner.TextToImageRunner().create_job(case["scheduler"],
+                                                    case.get("prompt", PROMPT),
+                                                    "",
+                                                    case["size"],
+                                                    case["size"],
+                                                    7.5,
+                                                    case["steps"],
+                                                    True,
+                                                    case.get("seed", 0),
+                                                    case["n_images"])
+    else:
+        runner = importlib.import_module("imagery.image_to_image_runner")
+        job_module = importlib.import_module("imagery.image_to_image_job")
+        pipeline_class = StableDiffusionImg2ImgPipeline
+
+        image_path = os.path.join(work_dir, f"init_{case['size']}.png")
+        Image.effect_noise((case["size"], case["size"]), 64).convert("RGB").save(
+            image_path
+        )
+
+        job = runner.ImageToImageRunner().create_job(image_path,
+                                                     case.get("prompt", PROMPT),
+                                                     "",
+                                                     STRENGTH,
+                                                     7.5,
+                                                     case["steps"],
+                                                     True,
+                                                     case.get("seed", 0),
+                                                     case["n_images"])
+
+    start = time.perf_counter()
+    model_registry.get_pipeline(pipeline_class)
+    load_s = time.perf_counter() - start
+
+    recorder = _Recorder()
+
+    start = time.perf_counter()
+    job_module.run(recorder, *job.job_args, 0, None)
+    run_s = time.perf_counter() - start
+
+    errors = [msg[1] for _timestamp, msg in recorder.messages if msg[0] == "error"]
+    if errors:
+        raise RuntimeError(errors[0])
+
+    first_update = next(timestamp for timestamp, msg in recorder.messages
+                        if msg[0] == "update")
+    step_times = _stage_times(recorder.messages, "unet_step")
+    decode_times = _stage_times(recorder.messages, "vae_decode")
+
+    return {
+        **case,
+        "load_s": load_s,
+        "time_to_first_step_s": first_update - start,
+        "step_s": statistics.median(step_times) if step_times else None,
+        "vae_decode_s": statistics.mean(decode_times),
+        "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "images_per_minute": case["n_images"] / run_s * 60,
+        "images": [msg[2] for _timestamp, msg in recorder.messages
+                   if msg[0] == "image"]
+    }
+
+
+def get_cases(args: argparse.Namespace) -> List[Dict]:
+    cases = []
+
+    for backend, size, steps, n_images in itertools.product(args.backends,
+                                                            args.sizes,
+                                                            args.steps,
+                                                            args.n_images):
+        settings = {"inference-backend": backend}
+
+        if "text_to_image" in args.modes:
+            cases += [{"mode": "text_to_image",
+                       "backend": backend,
+                       "scheduler": scheduler,
+                       "size": size,
+                       "steps": steps,
+                       "n_images": n_images,
+                       "settings": settings}
+                      for scheduler in args.schedulers]
+
+        if "image_to_image" in args.modes:
+            cases.append({"mode": "image_to_image",
+                          "backend": backend,
+                          "size": size,
+                          "steps": steps,
+                          "n_images": n_images,
+                          "settings": settings})
+
+    return cases
+
+
+def prepare_environment(work_dir: str, gpu: bool) -> Dict[str, str]:
+    """Environment for the case processes, isolated from the user's data."""
+    schema_dir = os.path.join(work_dir, "schemas")
+    os.makedirs(schema_dir, exist_ok=True)
+    subprocess.run(["glib-compile-schemas",
+                    f"--targetdir={schema_dir}",
+                    os.path.join(REPO_DIR, "data")],
+                   check=True)
+
+    env = dict(os.environ,
+               GSETTINGS_SCHEMA_DIR=schema_dir,
+               GSETTINGS_BACKEND="memory",
+               XDG_CACHE_HOME=os.path.join(work_dir, "cache"),
+               XDG_DATA_HOME=os.path.join(work_dir, "data"))
+    if not gpu:
+        env["CUDA_VISIBLE_DEVICES"] = ""
+
+    return env
+
+
+def run_cases(cases: List[Dict],
+              source: str,
+              model_dir: str,
+              work_dir: str,
+              env: Dict[str, str]) -> List[Dict]:
+    """Run every case in a fresh process and return their results."""
+    results = []
+
+    for case in cases:
+        result = subprocess.run([sys.executable,
+                                 os.path.abspath(__file__),
+                                 "--source", source,
+                                 "--case", json.dumps(case),
+                                 "--model-dir", model_dir,
+                                 "--work-dir", work_dir],
+                                env=env,
+                                stdout=subprocess.PIPE,
+                                check=True,
+                                text=True)
+        results.append(json.loads(result.stdout.splitlines()[-1]))
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--source", default=os.path.join(REPO_DIR, "src"),
+                        help="directory of the imagery package to benchmark")
+    parser.add_argument("--modes", nargs="+",
+                        default=["text_to_image", "image_to_image"],
+                        choices=["text_to_image", "image_to_image"])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[64, 128])
+    parser.add_argument("--steps", nargs="+", type=int, default=[10, 25])
+    parser.add_argument("--n-images", nargs="+", type=int, default=[1, 4])
+    parser.add_argument("--schedulers", nargs="+",
+                        default=TEXT_TO_IMAGE_SCHEDULERS,
+                        help="schedulers for the text-to-image cases")
+    parser.add_argument("--backends", nargs="+", default=["pytorch"],
+                        choices=["pytorch", "onnxruntime"],
+                        help="inference backends, the first ONNX Runtime case "
+                        "includes the export in load_s")
+    parser.add_argument("--gpu", action="store_true",
+                        help="use CUDA if available instead of the CPU")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    parser.add_argument("--model-dir", help=argparse.SUPPRESS)
+    parser.add_argument("--work-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case is not None:
+        load_package(args.source)
+        print(json.dumps(run_case(json.loads(args.case),
+                                  args.model_dir,
+                                  args.work_dir)))
+        return
+
+    with tempfile.TemporaryDirectory(prefix="imagery-benchmark-") as work_dir:
+        model_dir = os.path.join(work_dir, "model")
+        build_tiny_model(model_dir)
+
+        env = prepare_environment(work_dir, args.gpu)
+
+        results = run_cases(get_cases(args), args.source, model_dir, work_dir, env)
+
+    print(json.dumps({"cases": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+# quantization_quality.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Check that the int8 model generates images close to the float32 one.
+
+Generates one image per seed with the float32 model and with its int8
+variant on the CPU, and compares every pair by PSNR and SSIM. bfloat16 is
+switched off for both, so only the quantization makes a difference. Exits
+with status 1 if the mean SSIM is below --min-ssim.
+
+By default the tiny random model of the generation benchmark is used,
+which only shows that the int8 path works. Pass --model-dir with the
+downloaded Stable Diffusion 1.5 folder to judge the image quality.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+from typing import Dict, List
+
+import numpy
+from PIL import Image
+
+from generation import REPO_DIR, build_tiny_model, prepare_environment, run_cases
+
+PROMPT = "a lighthouse on a cliff at sunset, oil painting"
+
+# Constants of the SSIM paper for 8 bit images
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+SSIM_WINDOW = 8
+
+
+def _load_gray(path: str) -> numpy.ndarray:
+    return numpy.asarray(Image.open(path).convert("L"), dtype=numpy.float64)
+
+
+def psnr(path_a: str, path_b: str) -> float:
+    mse = numpy.mean((_load_gray(path_a) - _load_gray(path_b)) ** 2)
+
+    return float("inf") if mse == 0 else float(10 * numpy.log10(255 ** 2 / mse))
+
+
+def ssim(path_a: str, path_b: str) -> float:
+    """Mean SSIM over non-overlapping windows of the grayscale images."""
+    image_a = _load_gray(path_a)
+    image_b = _load_gray(path_b)
+
+    height = image_a.shape[0] - image_a.shape[0] % SSIM_WINDOW
+    width = image_a.shape[1] - image_a.shape[1] % SSIM_WINDOW
+
+    def windows(image: numpy.ndarray) -> numpy.ndarray:
+        return (image[:height, :width]
+                .reshape(height // SSIM_WINDOW, SSIM_WINDOW,
+                         width // SSIM_WINDOW, SSIM_WINDOW)
+                .transpose(0, 2, 1, 3)
+                .reshape(-1, SSIM_WINDOW * SSIM_WINDOW))
+
+    windows_a = windows(image_a)
+    windows_b = windows(image_b)
+
+    mean_a = windows_a.mean(axis=1)
+    mean_b = windows_b.mean(axis=1)
+    var_a = windows_a.var(axis=1)
+    var_b = windows_b.var(axis=1)
+    covariance = ((windows_a - mean_a[:, None])
+                  * (windows_b - mean_b[:, None])).mean(axis=1)
+
+    values = (((2 * mean_a * mean_b + SSIM_C1) * (2 * covariance + SSIM_C2))
+              / ((mean_a ** 2 + mean_b ** 2 + SSIM_C1) * (var_a + var_b + SSIM_C2)))
+
+    return float(values.mean())
+
+
+def generate(args: argparse.Namespace,
+             model_dir: str,
+             work_dir: str,
+             env: Dict[str, str],
+             quantized: bool) -> List[str]:
+    """Generate an image for every seed, return their paths."""
+    paths = []
+
+    for seed in args.seeds:
+        case = {"mode": "text_to_image",
+                "scheduler": "PNDMScheduler",
+                "size": args.size,
+                "steps": args.steps,
+                "n_images": 1,
+                "prompt": PROMPT,
+                "seed": seed,
+                "settings": {"quantized-model": quantized,
+                             "cpu-bfloat16": False}}
+
+        result = run_cases([case], args.source, model_dir, work_dir, env)[0]
+
+        # The next case writes to the same file
+        path = os.path.join(work_dir,
+                            f"{'int8' if quantized else 'fp32'}_{seed}.png")
+        shutil.copyfile(result["images"][0], path)
+        paths.append(path)
+
+    return paths
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--source", default=os.path.join(REPO_DIR, "src"),
+                        help="directory of the imagery package to check")
+    parser.add_argument("--model-dir",
+                        help="model to use instead of the tiny random one")
+    parser.add_argument("--seeds", nargs="+", type=int, default=[0, 1, 2, 3])
+    parser.add_argument("--size", type=int, default=128)
+    parser.add_argument("--steps", type=int, default=25)
+    parser.add_argument("--min-ssim", type=float, default=0.85,
+                        help="lowest acceptable mean SSIM")
+    parser.add_argument("--keep-images",
+                        help="directory to copy the compared images to")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="imagery-benchmark-") as work_dir:
+        model_dir = args.model_dir
+        if model_dir is None:
+            model_dir = os.path.join(work_dir, "model")
+            build_tiny_model(model_dir)
+
+        env = prepare_environment(work_dir, gpu=False)
+
+        reference = generate(args, model_dir, work_dir, env, quantized=False)
+        quantized = generate(args, model_dir, work_dir, env, quantized=True)
+
+        pairs = [{"seed": seed,
+                  "psnr": psnr(fp32_path, int8_path),
+                  "ssim": ssim(fp32_path, int8_path)}
+                 for seed, fp32_path, int8_path in zip(args.seeds,
+                                                       reference,
+                                                       quantized)]
+
+        if args.keep_images is not None:
+            os.makedirs(args.keep_images, exist_ok=True)
+            for path in reference + quantized:
+                shutil.copy(path, args.keep_images)
+
+    mean_ssim = statistics.mean(pair["ssim"] for pair in pairs)
+
+    print(json.dumps({"mean_ssim": mean_ssim,
+                      "min_ssim": args.min_ssim,
+                      "pairs": pairs}, indent=2))
+
+    if mean_ssim < args.min_ssim:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+# startup_time.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Measure the time from launching Imagery until its window is shown.
+
+Starts the installed imagery launcher several times and prints the timings
+as JSON. With --importtime, the launcher is also run once under
+python -X importtime and the slowest imports are added to the report.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+
+def measure_startup(launcher: str) -> float:
+    env = dict(os.environ, IMAGERY_STARTUP_BENCHMARK=str(time.time()))
+
+    result = subprocess.run([sys.executable, launcher],
+                            env=env,
+                            stdout=subprocess.PIPE,
+                            check=True,
+                            text=True)
+
+    for line in result.stdout.splitlines():
+        if line.startswith("{"):
+            return json.loads(line)["window_shown"]
+
+    raise RuntimeError("Imagery did not report its startup time")
+
+
+def measure_imports(launcher: str, top: int) -> List[Dict]:
+    env = dict(os.environ, IMAGERY_STARTUP_BENCHMARK=str(time.time()))
+
+    result = subprocess.run([sys.executable, "-X", "importtime", launcher],
+                            env=env,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE,
+                            check=True,
+                            text=True)
+
+    imports: List[Dict] = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+
+        _self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        imports.append({"module": module.strip(),
+                        "cumulative_ms": int(cumulative_us) / 1000})
+
+    imports.sort(key=lambda entry: entry["cumulative_ms"], reverse=True)
+
+    return imports[:top]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--launcher", default=shutil.which("imagery"),
+                        help="path of the installed imagery launcher")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--importtime", action="store_true",
+                        help="also report the slowest imports")
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.launcher is None:
+        parser.error("imagery launcher not found, pass --launcher")
+
+    timings = [measure_startup(args.launcher) for _ in range(args.runs)]
+
+    report: Dict = {
+        "runs": timings,
+        "median_s": statistics.median(timings),
+        "min_s": min(timings)
+    }
+
+    if args.importtime:
+        report["slowest_imports"] = measure_imports(args.launcher, args.top)
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# batch_planner.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+from enum import Enum
+from typing import List, Tuple
+
+# Rough fp32 numbers for the SD 1.5 UNet and VAE. They only have to be
+# good enough to keep a run clear of swapping, not to predict the exact
+# peak.
+BYTES_PER_FLOAT = 4
+VAE_SCALE_FACTOR = 8
+ATTENTION_HEADS = 8
+# Activations kept alive per latent pixel and UNet batch entry
+UNET_FLOATS_PER_LATENT_PIXEL = 2048
+# Activations kept alive per output pixel while decoding an image
+VAE_FLOATS_PER_PIXEL = 768
+
+# Share of the physical memory used when no budget is configured
+AUTO_BUDGET_SHARE = 0.4
+
+
+class AttentionMode(Enum):
+    DEFAULT = 0
+    SLICED = 1
+
+
+def get_auto_budget() -> int:
+    return int(os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+               * AUTO_BUDGET_SHARE)
+
+
+def estimate_peak_bytes(height: int,
+                        width: int,
+                        batch_size: int,
+                        attention_mode: AttentionMode,
+                        guidance: bool = True) -> int:
+    """Estimate the peak activation memory of one pipeline call.
+
+    The weights are not included. With classifier-free guidance the UNet
+    runs on twice the batch size.
+    """
+    latent_pixels = (height // VAE_SCALE_FACTOR) * (width // VAE_SCALE_FACTOR)
+    unet_batch = batch_size * 2 if guidance else batch_size
+
+    unet = unet_batch * latent_pixels * UNET_FLOATS_PER_LATENT_PIXEL
+
+    # Attention scores and their softmax at the highest resolution, for all
+    # heads at once or, sliced, for one head at a time
+    heads = ATTENTION_HEADS if attention_mode == AttentionMode.DEFAULT else 1
+    attention = unet_batch * heads * latent_pixels * latent_pixels * 2
+
+    # The VAE decodes one image at a time, including its mid-block
+    # attention over all latent pixels
+    vae = height * width * VAE_FLOATS_PER_PIXEL + latent_pixels * latent_pixels
+
+    return max(unet + attention, vae) * BYTES_PER_FLOAT
+
+
+def plan_micro_batches(n_images: int,
+                       height: int,
+                       width: int,
+                       budget: int,
+                       guidance: bool = True) -> Tuple[List[int], AttentionMode]:
+    """Split n_images into micro-batch sizes that fit into budget bytes.
+
+    Attention slicing is only used if a single image does not fit
+    otherwise. If even that does not fit, images are generated one by one.
+    The images are spread evenly over the fewest micro-batches that fit.
+    """
+    attention_mode = AttentionMode.DEFAULT
+    if estimate_peak_bytes(height, width, 1, attention_mode, guidance) > budget:
+        attention_mode = AttentionMode.SLICED
+
+    if n_images < 1:
+        return [], attention_mode
+
+    batch_size = n_images
+    while batch_size > 1 and estimate_peak_bytes(height,
+                                                 width,
+                                                 batch_size,
+                                                 attention_mode,
+                                                 guidance) > budget:
+        batch_size -= 1
+
+    n_batches = -(-n_images // batch_size)
+    size, n_larger = divmod(n_images, n_batches)
+
+    return ([size + 1] * n_larger + [size] * (n_batches - n_larger),
+            attention_mode)
@@ -0,0 +1,302 @@
+# cli.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Headless batch generation.
+
+Runs the prompts of a JSON Lines file through the job queue without
+importing Gtk, so it also works on machines without a display:
+
+    imagery generate --prompts prompts.jsonl --out results/
+
+Every line holds one request. Only "prompt" is required; requests with an
+"image" are image-to-image runs. The other keys default to the values the
+pages start with for the selected model family, and take the values the
+pages allow:
+
+    {"prompt": "a lighthouse at dusk", "n_images": 4, "seed": 42}
+    {"prompt": "as an oil painting", "image": "photo.png", "strength": 0.6}
+
+Images are moved into the output directory as soon as they are ready and
+their paths are printed. manifest.json in the output directory lists every
+request with its status and images, and is rewritten after each request.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+from .download_manager import get_missing_files
+from .image_to_image_runner import ImageToImageRunner
+from .job_queue import JobState, QueuedJob, job_queue
+from .model_files import get_model_family
+from .text_to_image_runner import TextToImageRunner
+
+# Steps and guidance scale come from the model family
+TEXT_TO_IMAGE_DEFAULTS = {
+    "neg_prompt": "",
+    "scheduler": "PNDMScheduler",
+    "height": 512,
+    "width": 512,
+    "n_images": 1
+}
+
+IMAGE_TO_IMAGE_DEFAULTS = {
+    "neg_prompt": "",
+    "strength": 0.8,
+    "n_images": 1
+}
+
+# Schedulers the text-to-image page offers
+SCHEDULERS = ["DDIMScheduler",
+              "DDPMScheduler",
+              "DPMSolverMultistepScheduler",
+              "EulerAncestralDiscreteScheduler",
+              "EulerDiscreteScheduler",
+              "LMSDiscreteScheduler",
+              "PNDMScheduler"]
+
+# Type and inclusive range of every request key, as the pages allow them
+REQUEST_KEYS: Dict[str, Tuple[Type, Optional[Tuple[float, float]]]] = {
+    "prompt": (str, None),
+    "neg_prompt": (str, None),
+    "image": (str, None),
+    "scheduler": (str, None),
+    "height": (int, (8, 4096)),
+    "width": (int, (8, 4096)),
+    "n_images": (int, (1, 12)),
+    "steps": (int, (1, 200)),
+    "guidance_scale": (float, (0, 100)),
+    "strength": (float, (0, 1)),
+    "seed": (int, (0, 2 ** 32))
+}
+
+TYPE_NAMES = {str: "string", int: "whole number", float: "number"}
+
+
+class InvalidRequest(ValueError):
+    pass
+
+
+def _check_value(key: str, value: Any) -> None:
+    value_type, value_range = REQUEST_KEYS[key]
+
+    # JSON numbers without a fraction are fine as floats, booleans are
+    # never numbers
+    if isinstance(value, bool) or not (
+        isinstance(value, value_type)
+        or (value_type is float and isinstance(value, int))
+    ):
+        raise InvalidRequest(f"\"{key}\" must be a {TYPE_NAMES[value_type]}")
+
+    if value_range is not None and not value_range[0] <= value <= value_range[1]:
+        raise InvalidRequest(f"\"{key}\" must be between {value_range[0]} "
+                             f"and {value_range[1]}")
+
+
+def _check_request(request: Any) -> None:
+    """Raise InvalidRequest if request is not one the pages could make."""
+    if not isinstance(request, dict):
+        raise InvalidRequest("a request must be a JSON object")
+
+    for key, value in request.items():
+        if key not in REQUEST_KEYS:
+            raise InvalidRequest(f"unknown key \"{key}\"")
+
+        _check_value(key, value)
+
+    if not request.get("prompt", "").strip():
+        raise InvalidRequest("missing \"prompt\"")
+
+    if "image" in request and not os.path.isfile(request["image"]):
+        raise InvalidRequest(f"image {request['image']} does not exist")
+
+    if request.get("scheduler", SCHEDULERS[0]) not in SCHEDULERS:
+        raise InvalidRequest(f"\"scheduler\" must be one of {', '.join(SCHEDULERS)}")
+
+    for key in ("height", "width"):
+        if request.get(key, 8) % 8 != 0:
+            raise InvalidRequest(f"\"{key}\" must be a multiple of 8")
+
+
+def _load_requests(path: str) -> List[Dict]:
+    """Read and check all requests before any of them is queued.
+
+    Raises InvalidRequest for the first request that is not valid.
+    """
+    family = get_model_family()
+    requests = []
+
+    with open(path, "r", encoding="utf-8") as prompts_file:
+        for line_number, line in enumerate(prompts_file, start=1):
+            if not line.strip():
+                continue
+
+            try:
+                request = json.loads(line)
+                _check_request(request)
+            except ValueError as error:
+                raise InvalidRequest(f"{path}:{line_number}: {error}") from error
+
+            defaults = (IMAGE_TO_IMAGE_DEFAULTS if "image" in request
+                        else TEXT_TO_IMAGE_DEFAULTS)
+            requests.append({**defaults,
+                             "steps": family.steps,
+                             "guidance_scale": family.guidance_scale,
+                             **request})
+
+    if not requests:
+        raise InvalidRequest(f"{path}: no requests")
+
+    return requests
+
+
+def _create_job(request: Dict) -> QueuedJob:
+    use_seed = "seed" in request
+    seed = request.get("seed", 0)
+
+    if "image" in request:
+        return ImageToImageRunner().create_job(os.path.abspath(request["image"]),
+                                               request["prompt"],
+                                               request["neg_prompt"],
+                                               request["strength"],
+                                               request["guidance_scale"],
+                                               request["steps"],
+                                               use_seed,
+                                               seed,
+                                               request["n_images"])
+
+    # Few-step models only work with their own scheduler
+    scheduler = get_model_family().scheduler or request["scheduler"]
+
+    return TextToImageRunner().create_job(scheduler,
+                                          request["prompt"],
+                                          request["neg_prompt"],
+                                          request["height"],
+                                          request["width"],
+                                          request["guidance_scale"],
+                                          request["steps"],
+                                          use_seed,
+                                          seed,
+                                          request["n_images"])
+
+
+class _BatchRun:
+    """Queues all requests and collects their results as they arrive."""
+
+    def __init__(self, requests: List[Dict], out_dir: str) -> None:
+        self._out_dir = out_dir
+        self._lock = threading.Lock()
+        self._done = threading.Semaphore(0)
+
+        self._results: List[Dict] = [{"request": request,
+                                      "status": JobState.PENDING.name.lower(),
+                                      "images": []}
+                                     for request in requests]
+        self._jobs = [_create_job(request) for request in requests]
+        self._started: Dict[QueuedJob, float] = {}
+
+    def _job_started(self, job: QueuedJob) -> None:
+        self._started[job] = time.monotonic()
+
+    def _image_ready(self, job: QueuedJob, image_index: int, path: str) -> None:
+        number = self._jobs.index(job)
+        out_path = os.path.join(self._out_dir,
+                                f"{number:04d}_{image_index:02d}.png")
+        shutil.move(path, out_path)
+
+        with self._lock:
+            self._results[number]["images"].append(out_path)
+
+        print(out_path, flush=True)
+
+    def _job_done(self, job: QueuedJob) -> None:
+        with self._lock:
+            result = self._results[self._jobs.index(job)]
+            result["status"] = job.state.name.lower()
+            if job in self._started:
+                result["seconds"] = round(time.monotonic() - self._started[job], 3)
+
+            self._write_manifest()
+
+        self._done.release()
+
+    def _write_manifest(self) -> None:
+        manifest_path = os.path.join(self._out_dir, "manifest.json")
+        tmp_path = manifest_path + ".tmp"
+
+        with open(tmp_path, "w", encoding="utf-8") as manifest_file:
+            json.dump(self._results, manifest_file, indent=2)
+
+        os.replace(tmp_path, manifest_path)
+
+    def run(self) -> bool:
+        """Run all requests, returns whether all of them finished."""
+        for job in self._jobs:
+            job.connect("started", self._job_started)
+            job.connect("image-ready", self._image_ready)
+            job.connect("finished", self._job_done)
+            job.connect("cancelled", self._job_done)
+            job_queue.enqueue(job)
+
+        try:
+            for _ in self._jobs:
+                self._done.acquire()  # pylint: disable=consider-using-with
+        except KeyboardInterrupt:
+            for job in self._jobs:
+                job_queue.cancel(job)
+            raise
+
+        return all(job.state == JobState.FINISHED for job in self._jobs)
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="imagery generate",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--prompts", required=True,
+                        help="JSON Lines file with one request per line")
+    parser.add_argument("--out", required=True,
+                        help="directory for the images and manifest.json")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.INFO)
+
+    try:
+        requests = _load_requests(args.prompts)
+    except InvalidRequest as error:
+        parser.error(str(error))
+    except OSError as error:
+        logging.error("Reading %s failed: %s", args.prompts, error)
+        return 1
+
+    if get_missing_files():
+        logging.error("Model files are missing, download them by starting "
+                      "Imagery once")
+        return 1
+
+    os.makedirs(args.out, exist_ok=True)
+
+    return 0 if _BatchRun(requests, args.out).run() else 1
@@ -0,0 +1,373 @@
+# compiled_graphs.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import warnings
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import torch
+from diffusers import DiffusionPipeline
+from gi.repository import GLib
+
+from .model_cache import get_source_key, is_cache_valid, save_cache_key
+from .settings_manager import is_compiled_model_enabled
+
+GRAPH_COMPONENTS = ["unet", "vae"]
+
+# Image size compiled for when warming up without any cached graphs, the
+# default of the text-to-image page
+WARM_UP_SIZE = 512
+
+
+def get_compiled_dir(model_id: str) -> str:
+    return os.path.join(GLib.get_user_cache_dir(),
+                        "compiled",
+                        os.path.basename(os.path.normpath(model_id)))
+
+
+class _UNetGraph(torch.nn.Module):
+    def __init__(self, unet: torch.nn.Module) -> None:
+        super().__init__()
+        self.unet = unet
+
+    def forward(self,
+                sample: torch.Tensor,
+                timestep: torch.Tensor,
+                encoder_hidden_states: torch.Tensor) -> torch.Tensor:
+        return self.unet(sample,
+                         timestep,
+                         encoder_hidden_states=encoder_hidden_states,
+                         return_dict=False)[0]
+
+
+class _VaeDecoderGraph(torch.nn.Module):
+    def __init__(self, vae: torch.nn.Module) -> None:
+        super().__init__()
+        self.vae = vae
+
+    def forward(self, latent_sample: torch.Tensor) -> torch.Tensor:
+        return self.vae.decode(latent_sample, return_dict=False)[0]
+
+
+def _get_tensors(module: torch.nn.Module) -> Iterator[Tuple[str, torch.Tensor]]:
+    yield from module.named_parameters()
+    yield from module.named_buffers()
+
+
+def _set_tensor(graph: torch.jit.ScriptModule,
+                name: str,
+                tensor: torch.Tensor) -> None:
+    path, _sep, attribute = name.rpartition(".")
+
+    setattr(graph.get_submodule(path) if path else graph, attribute, tensor)
+
+
+def _strip_weights(graph: torch.jit.ScriptModule) -> None:
+    """Replace the weights of graph with empty tensors.
+
+    Traced graphs read their weights as attributes, so they can be saved
+    without them and get the ones of the loaded model bound back in.
+    """
+    for name, tensor in list(_get_tensors(graph)):
+        empty = torch.empty(0, dtype=tensor.dtype)
+
+        _set_tensor(graph,
+                    name,
+                    torch.nn.Parameter(empty, requires_grad=False)
+                    if isinstance(tensor, torch.nn.Parameter) else empty)
+
+
+def _bind_weights(graph: torch.jit.ScriptModule, module: torch.nn.Module) -> None:
+    """Share the weights of module with graph, which was traced from it."""
+    tensors = dict(_get_tensors(module))
+
+    for name, _tensor in list(_get_tensors(graph)):
+        _set_tensor(graph, name, tensors[name])
+
+
+def _describe_attention(module: torch.nn.Module) -> List[str]:
+    # Attention slicing and processors are picked in Python, so a graph
+    # only holds the ones it was traced with
+    described = set()
+
+    for submodule in module.modules():
+        if not hasattr(submodule, "_slice_size") and not hasattr(submodule,
+                                                                 "processor"):
+            continue
+
+        processor = getattr(submodule, "processor", None)
+        described.add(f"{type(processor).__name__}:"
+                      f"{getattr(submodule, '_slice_size', None)}:"
+                      f"{getattr(processor, 'slice_size', None)}")
+
+    return sorted(described)
+
+
+def _is_autocast_enabled() -> bool:
+    return torch.is_autocast_enabled() or torch.is_autocast_cpu_enabled()
+
+
+class CompiledGraphs:
+    """TorchScript graphs of the UNet and VAE decoder of a model.
+
+    Every input shape gets its own graph, traced on its first use and kept
+    in the cache directory, so the eager dispatch of the models' Python code
+    is only paid once per image size. The graph files hold no weights, they
+    share the ones of the loaded model.
+
+    Only used while the compiled model is switched on. Autocast and other
+    arguments than the ones the jobs pass fall back to the eager models.
+    """
+
+    def __init__(self,
+                 model_id: str,
+                 unet: torch.nn.Module,
+                 vae: torch.nn.Module) -> None:
+        self._model_id = model_id
+        self._dir = get_compiled_dir(model_id)
+        self._checked = False
+
+        self._modules = {"unet": _UNetGraph(unet), "vae": _VaeDecoderGraph(vae)}
+        self._graphs: Dict[str, torch.jit.ScriptModule] = {}
+
+    def _get_manifest_path(self) -> str:
+        return os.path.join(self._dir, "compiled.json")
+
+    def _get_cache_key(self) -> Dict[str, Any]:
+        return {"torch": torch.__version__,
+                "sources": get_source_key(self._model_id, GRAPH_COMPONENTS)}
+
+    def _check_dir(self) -> None:
+        """Drop the cached graphs if they were traced from other weights."""
+        if self._checked:
+            return
+
+        self._checked = True
+
+        key = self._get_cache_key()
+        if is_cache_valid(self._get_manifest_path(), key):
+            return
+
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+        try:
+            os.makedirs(self._dir, exist_ok=True)
+        except OSError as err:
+            logging.warning("Creating %s failed: %s", self._dir, err)
+            return
+
+        save_cache_key(self._get_manifest_path(), key)
+
+    def _get_key(self,
+                 component: str,
+                 inputs: Tuple[torch.Tensor, ...]) -> Dict[str, Any]:
+        return {"component": component,
+                "device": str(inputs[0].device),
+                "inputs": [[list(tensor.shape), str(tensor.dtype)]
+                           for tensor in inputs],
+                "attention": _describe_attention(self._modules[component])}
+
+    def _get_graph_path(self, name: str) -> str:
+        return os.path.join(self._dir, f"{name}.pt")
+
+    def _load(self, name: str, component: str) -> Optional[torch.jit.ScriptModule]:
+        path = self._get_graph_path(name)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            graph = torch.jit.load(path, map_location="cpu")
+            _bind_weights(graph, self._modules[component])
+        except (RuntimeError, KeyError, AttributeError) as err:
+            logging.warning("Loading compiled %s failed, compiling again: %s",
+                            component, err)
+            return None
+
+        return graph
+
+    def _compile(self,
+                 name: str,
+                 key: Dict[str, Any],
+                 inputs: Tuple[torch.Tensor, ...]) -> torch.jit.ScriptModule:
+        component = key["component"]
+        module = self._modules[component]
+
+        logging.info("Compiling %s for %s", component, key["inputs"])
+
+        with warnings.catch_warnings(), torch.no_grad():
+            # Traces are made for a fixed shape, which is what they warn about
+            warnings.simplefilter("ignore", torch.jit.TracerWarning)
+
+            graph = torch.jit.trace(module, inputs, check_trace=False)
+
+        path = self._get_graph_path(name)
+
+        try:
+            _strip_weights(graph)
+            torch.jit.save(graph, path + ".tmp")
+            os.replace(path + ".tmp", path)
+        except (OSError, RuntimeError) as err:
+            logging.warning("Saving compiled %s failed: %s", component, err)
+        finally:
+            _bind_weights(graph, module)
+
+        return graph
+
+    def _get_graph(
+        self,
+        component: str,
+        inputs: Tuple[torch.Tensor, ...]
+    ) -> Optional[torch.jit.ScriptModule]:
+        if (not is_compiled_model_enabled()
+                or torch.jit.is_tracing()
+                or _is_autocast_enabled()):
+            return None
+
+        self._check_dir()
+
+        key = self._get_key(component, inputs)
+        name = component + "-" + hashlib.sha1(
+            json.dumps(key, sort_keys=True).encode()
+        ).hexdigest()[:16]
+
+        graph = self._graphs.get(name)
+
+        if graph is None:
+            graph = self._load(name, component) or self._compile(name, key, inputs)
+            self._graphs[name] = graph
+
+        return graph
+
+    def run_unet(self,
+                 sample: torch.Tensor,
+                 timestep: Any,
+                 encoder_hidden_states: torch.Tensor) -> Optional[torch.Tensor]:
+        """The UNet prediction from its graph, None to use the eager UNet."""
+        # The UNet embeds timesteps as float32, whatever the scheduler gives
+        timestep = torch.as_tensor(timestep, dtype=torch.float32).reshape(())
+        inputs = (sample, timestep, encoder_hidden_states)
+
+        graph = self._get_graph("unet", inputs)
+
+        return None if graph is None else graph(*inputs)
+
+    def run_vae_decoder(self, latent_sample: torch.Tensor) -> Optional[torch.Tensor]:
+        """The decoded images from the graph, None to use the eager VAE."""
+        graph = self._get_graph("vae", (latent_sample,))
+
+        return None if graph is None else graph(latent_sample)
+
+    def warm_up(self, pipeline: DiffusionPipeline) -> None:
+        """Load all cached graphs, or compile for the default image size.
+
+        Run in the background after the app started, so the first
+        generation finds its graphs in memory.
+        """
+        if not is_compiled_model_enabled():
+            return
+
+        self._check_dir()
+
+        try:
+            names = sorted(file_name[:-len(".pt")]
+                           for file_name in os.listdir(self._dir)
+                           if file_name.endswith(".pt"))
+        except OSError:
+            names = []
+
+        for name in names:
+            if name not in self._graphs:
+                graph = self._load(name, name.partition("-")[0])
+                if graph is not None:
+                    self._graphs[name] = graph
+
+        if self._graphs:
+            logging.info("Loaded %d compiled graphs", len(self._graphs))
+            return
+
+        latent_size = WARM_UP_SIZE // pipeline.vae_scale_factor
+        unet = pipeline.unet
+        device = pipeline.device
+
+        # A single image with classifier-free guidance
+        sample = torch.zeros((2, unet.in_channels, latent_size, latent_size),
+                             device=device)
+        embeddings = torch.zeros((2,
+                                  pipeline.tokenizer.model_max_length,
+                                  unet.config.cross_attention_dim),
+                                 device=device)
+
+        with torch.no_grad():
+            self.run_unet(sample, 0, embeddings)
+            self.run_vae_decoder(sample[:1])
+
+
+def install(model_id: str,
+            unet: torch.nn.Module,
+            vae: torch.nn.Module) -> CompiledGraphs:
+    """Route the UNet and VAE decoder through their compiled graphs."""
+    graphs = CompiledGraphs(model_id, unet, vae)
+
+    unet_forward = unet.forward
+    vae_decode = vae.decode
+
+    def compiled_unet_forward(sample: torch.Tensor,
+                              timestep: Any,
+                              encoder_hidden_states: torch.Tensor,
+                              return_dict: bool = True,
+                              **kwargs: Any) -> Any:
+        prediction = None
+        if not any(value is not None for value in kwargs.values()):
+            prediction = graphs.run_unet(sample, timestep, encoder_hidden_states)
+
+        if prediction is None:
+            return unet_forward(sample,
+                                timestep,
+                                encoder_hidden_states,
+                                return_dict=return_dict,
+                                **kwargs)
+
+        return SimpleNamespace(sample=prediction) if return_dict else (prediction,)
+
+    def compiled_vae_decode(latent_sample: torch.Tensor,
+                            return_dict: bool = True) -> Any:
+        image = graphs.run_vae_decoder(latent_sample)
+
+        if image is None:
+            return vae_decode(latent_sample, return_dict=return_dict)
+
+        return SimpleNamespace(sample=image) if return_dict else (image,)
+
+    unet.forward = compiled_unet_forward
+    vae.decode = compiled_vae_decode
+
+    # Found by the warm-up job through the pipeline
+    unet.compiled_graphs = graphs
+
+    return graphs
+
+
+def get_compiled_graphs(pipeline: DiffusionPipeline) -> Optional[CompiledGraphs]:
+    """The graphs installed for the UNet of pipeline, if any."""
+    return getattr(pipeline.unet, "compiled_graphs", None)
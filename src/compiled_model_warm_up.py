@@ -0,0 +1,38 @@
+# compiled_model_warm_up.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from multiprocessing import connection
+
+from diffusers import StableDiffusionPipeline
+
+from .compiled_graphs import get_compiled_graphs
+from .model_registry import model_registry
+
+
+def run(_child_connection: connection.Connection) -> None:
+    """Load the model and its compiled graphs ahead of the first generation.
+
+    Graphs of image sizes generated before come from the cache, without any
+    the default size is compiled.
+    """
+    pipeline = model_registry.get_pipeline(StableDiffusionPipeline)
+
+    graphs = get_compiled_graphs(pipeline)
+    if graphs is not None:
+        graphs.warm_up(pipeline)
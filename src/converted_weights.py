@@ -0,0 +1,77 @@
+# converted_weights.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import os
+from typing import Dict, Optional
+
+from .file import File
+from .model_files import sd15_folder
+
+manifest_path = os.path.join(sd15_folder, "converted_weights.json")
+
+# Pickled weight files and the safetensors files diffusers and transformers
+# prefer loading when both are present
+safetensors_names = {
+    "pytorch_model.bin": "model.safetensors",
+    "diffusion_pytorch_model.bin": "diffusion_pytorch_model.safetensors"
+}
+
+
+def get_safetensors_path(path: str) -> Optional[str]:
+    directory, name = os.path.split(path)
+
+    if name not in safetensors_names:
+        return None
+
+    return os.path.join(directory, safetensors_names[name])
+
+
+def load_manifest() -> Dict[str, Dict]:
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(manifest: Dict[str, Dict]) -> None:
+    tmp_path = manifest_path + ".tmp"
+
+    with open(tmp_path, "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    os.replace(tmp_path, manifest_path)
+
+
+def get_converted(file: File) -> Optional[Dict]:
+    """Return the manifest entry of the safetensors version of file, if any.
+
+    The entry holds the digest and size of the pickled source file as well
+    as the sha256 the converted file had when it was written.
+    """
+    path = get_safetensors_path(file.path)
+    if path is None or not os.path.isfile(path):
+        return None
+
+    entry = load_manifest().get(path)
+    if entry is None or entry["source_sha256"] != file.sha256:
+        return None
+
+    return dict(entry, path=path)
@@ -0,0 +1,155 @@
+# cpu_performance.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import contextlib
+import functools
+import logging
+import os
+from typing import ContextManager, Dict, List, Set
+
+import torch
+from diffusers import DiffusionPipeline
+
+from .settings_manager import (get_cpu_threads, is_cpu_bfloat16_enabled,
+                               is_cpu_performance_enabled,
+                               is_quantized_model_enabled)
+
+CPUINFO_PATH = "/proc/cpuinfo"
+
+# CPU flags of native bfloat16 matrix instructions. Without them bfloat16
+# is emulated and slower than float32.
+BFLOAT16_FLAGS = {"avx512_bf16", "amx_bf16"}
+
+# Threads torch picked for itself, restored when the mode is switched off
+_DEFAULT_THREADS = torch.get_num_threads()
+
+
+def _read_cpuinfo() -> List[Dict[str, str]]:
+    """The entries of /proc/cpuinfo, one per logical CPU."""
+    try:
+        with open(CPUINFO_PATH, "r", encoding="utf-8") as cpuinfo_file:
+            blocks = cpuinfo_file.read().strip().split("\n\n")
+    except OSError:
+        return []
+
+    cpus = []
+    for block in blocks:
+        cpu = {}
+        for line in block.splitlines():
+            key, _sep, value = line.partition(":")
+            cpu[key.strip()] = value.strip()
+        cpus.append(cpu)
+
+    return cpus
+
+
+def get_physical_cores() -> int:
+    """Physical cores this process may run on, hyperthreads not counted."""
+    allowed: Set[int] = os.sched_getaffinity(0)
+
+    cores = {(cpu.get("physical id"), cpu.get("core id"))
+             for cpu in _read_cpuinfo()
+             if int(cpu.get("processor", -1)) in allowed}
+
+    # Without topology information every logical CPU counts as a core
+    if not cores or (None, None) in cores:
+        return len(allowed)
+
+    return len(cores)
+
+
+@functools.lru_cache(maxsize=None)
+def has_native_bfloat16() -> bool:
+    cpus = _read_cpuinfo()
+    if not cpus:
+        return False
+
+    return bool(BFLOAT16_FLAGS & set(cpus[0].get("flags", "").split()))
+
+
+def _set_threads() -> None:
+    threads = get_cpu_threads() or get_physical_cores()
+
+    if torch.get_num_threads() != threads:
+        logging.info("Using %d threads for inference", threads)
+        torch.set_num_threads(threads)
+
+    # The pipeline runs one operator after another, a single inter-op
+    # thread keeps the intra-op pool from being oversubscribed. Torch only
+    # takes this before any parallel work started, so it can fail once the
+    # worker generated something with the mode switched off.
+    if torch.get_num_interop_threads() != 1:
+        try:
+            torch.set_interop_threads(1)
+        except RuntimeError:
+            pass
+
+
+def _set_attention(pipeline: DiffusionPipeline, fused: bool) -> None:
+    # Scaled dot product attention needs torch 2 and a diffusers release
+    # with attention processors, older versions keep their own attention
+    if not hasattr(torch.nn.functional, "scaled_dot_product_attention"):
+        return
+
+    try:
+        # pylint: disable-next=import-outside-toplevel
+        from diffusers.models.attention_processor import (AttnProcessor,
+                                                          AttnProcessor2_0)
+    except ImportError:
+        return
+
+    pipeline.unet.set_attn_processor(AttnProcessor2_0() if fused
+                                     else AttnProcessor())
+
+
+def configure(pipeline: DiffusionPipeline) -> None:
+    """Set up a pipeline on the CPU as the performance settings say.
+
+    Cheap when nothing changed since the last call, so it is done for
+    every job and picks up changed settings without reloading the model.
+    """
+    enabled = is_cpu_performance_enabled()
+    memory_format = torch.channels_last if enabled else torch.contiguous_format
+
+    if enabled:
+        _set_threads()
+    elif torch.get_num_threads() != _DEFAULT_THREADS:
+        torch.set_num_threads(_DEFAULT_THREADS)
+
+    _set_attention(pipeline, enabled)
+
+    pipeline.unet.to(memory_format=memory_format)
+    pipeline.vae.to(memory_format=memory_format)
+
+
+def autocast(device: torch.device) -> ContextManager:
+    """Run the enclosed UNet and VAE calls in bfloat16 where that is faster.
+
+    Only on CPUs with native bfloat16 instructions and with both the
+    performance mode and bfloat16 switched on. The int8 layers of the
+    quantized model only take float32 inputs, so not with that either.
+    """
+    if (device.type == "cpu"
+            and is_cpu_performance_enabled()
+            and is_cpu_bfloat16_enabled()
+            and not is_quantized_model_enabled()
+            and has_native_bfloat16()):
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+
+    return contextlib.nullcontext()
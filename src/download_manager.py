@@ -19,94 +19,309 @@
 
 import hashlib
 import logging
-from pathlib import Path
-from typing import List, Optional
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.client import HTTPException
+from typing import List, Optional, Tuple
 
-from gi.repository import Gio, GLib, GObject
+from gi.repository import Gio, GObject
 
+from .converted_weights import get_converted, get_safetensors_path
 from .file import File
-from .model_files import sd_files_size
+from .file_download import DownloadCancelled, FileDownload, query_file
+from .image_to_image_runner import ImageToImageRunner
+from .inference_worker import inference_worker
+from .model_files import get_files, obsolete_files, safety_checker_components
+from .settings_manager import (get_inference_backend, is_nsfw_allowed,
+                               is_quantized_model_enabled)
+from .text_to_image_runner import TextToImageRunner
+from .verification_cache import verification_cache
 
+MAX_CONNECTIONS = 6
+VERIFY_BUFFER_SIZE = 8 * 1024 * 1024
 
-class DownloadManager(GObject.Object):
+
+def get_required_files() -> List[File]:
+    """Files of the model components the runners load with the current settings."""
+    components = TextToImageRunner.components + ImageToImageRunner.components
+    if not is_nsfw_allowed():
+        components = components + safety_checker_components
+
+    return get_files(components)
+
+
+def get_missing_files() -> List[File]:
+    """Required files that are neither downloaded nor converted.
+
+    Only checks for existence, verifying is left to the DownloadManager.
+    """
+    return [file for file in get_required_files()
+            if not file.exists() and get_converted(file) is None]
+
+
+class DownloadManager(GObject.Object):  # pylint: disable=too-many-instance-attributes
     __gsignals__ = {
         "reset": (GObject.SignalFlags.RUN_FIRST, None, ()),
         "verify": (GObject.SignalFlags.RUN_FIRST, None, ()),
         "verify-progress": (GObject.SignalFlags.RUN_FIRST, None, (float,)),
+        "convert": (GObject.SignalFlags.RUN_FIRST, None, ()),
         "update": (GObject.SignalFlags.RUN_FIRST,
                    None,
                    (int, int,)),
         "cancelled": (GObject.SignalFlags.RUN_FIRST, None, ()),
+        "failed": (GObject.SignalFlags.RUN_FIRST, None, (str,)),
         "finished": (GObject.SignalFlags.RUN_FIRST, None, ())
     }
 
-    def __init__(self,
-                 files: List[File]):
+    def __init__(self):
         super().__init__()
 
-        self._files = files
+        self._files: List[File] = []
         self._current_download_size: int = 0
-        self._total_download_size: int = sd_files_size
+        self._total_download_size: int = 0
+        self._verified_size: int = 0
+        self._total_verify_size: int = 0
+        self._progress_lock = threading.Lock()
 
         self._task: Optional[Gio.Task] = None
         self._task_cancellable: Gio.Cancellable = Gio.Cancellable()
         self._cancelled: bool = False
+        self._failed: bool = False
+        self._error: str = ""
+        self._deep_verify: bool = False
+
+    def _get_sha256(self, path: str) -> Optional[str]:
+        sha256 = hashlib.sha256()
+
+        # Large unbuffered reads, hashlib releases the GIL for them, so
+        # several files are really hashed in parallel
+        buffer = bytearray(VERIFY_BUFFER_SIZE)
+        view = memoryview(buffer)
+        with open(path, "rb", buffering=0) as open_file:
+            while (size := open_file.readinto(buffer)):
+                if self._cancelled is True:
+                    return None
+
+                sha256.update(view[:size])
+
+                self._verify_progress_cb(size)
+
+        return sha256.hexdigest()
+
+    def _verify_progress_cb(self, num_bytes: int) -> None:
+        with self._progress_lock:
+            self._verified_size += num_bytes
+
+            fraction = self._verified_size / max(self._total_verify_size, 1)
+
+        self.emit("verify-progress", fraction)
+
+    def _verify_all(self,
+                    candidates: List[Tuple[File, str, str]]) -> Optional[List[File]]:
+        """Hash the (file, path, sha256) candidates in parallel.
+
+        Returns the files whose digest did not match, None if cancelled.
+        """
+        to_hash = [(file, path, sha256) for file, path, sha256 in candidates
+                   if self._deep_verify
+                   or not verification_cache.is_verified(path, sha256)]
+
+        if not to_hash:
+            return []
+
+        self.emit("verify")
+
+        self._verified_size = 0
+        self._total_verify_size = sum(os.path.getsize(path)
+                                      for _file, path, _sha256 in to_hash)
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            digests = list(executor.map(
+                lambda candidate: self._get_sha256(candidate[1]), to_hash
+            ))
+
+        if self._cancelled is True:
+            return None
+
+        failed: List[File] = []
+        for (file, path, sha256), digest in zip(to_hash, digests):
+            if digest == sha256:
+                verification_cache.add(path, sha256)
+            else:
+                verification_cache.remove(path)
+                failed.append(file)
+
+        verification_cache.save()
+
+        return failed
+
+    def _remove_obsolete_files(self) -> None:
+        for path in obsolete_files:
+            if os.path.isfile(path):
+                logging.info("Removing obsolete model file %s", path)
+                os.remove(path)
 
     def _start_download(self, _task, _source_object, _task_data, _cancellable):
         logging.info("Start downloading")
+
+        self._remove_obsolete_files()
         self._current_download_size: int = 0
 
         download_queue: List[File] = []
 
+        candidates: List[Tuple[File, str, str]] = []
+
         for file in self._files:
             if file.exists():
-                path: Path = Path(file.path)
-                current_size: int = 0
-                buffer_size = 65536
-                sha256 = hashlib.sha256()
-                with open(path, "rb") as open_file:
-                    while (data := open_file.read(buffer_size)):
-                        if self._cancelled is True:
-                            return
-
-                        sha256.update(data)
-
-                        current_size += buffer_size
+                candidates.append((file, file.path, file.sha256))
+            elif (converted := get_converted(file)) is not None:
+                candidates.append((file, converted["path"], converted["sha256"]))
+            else:
+                download_queue.append(file)
 
-                if file.sha256 == sha256.hexdigest():
-                    self._total_download_size -= file.get_size()
-                    continue
+        failed = self._verify_all(candidates)
+        if failed is None:
+            return
 
-            download_queue.append(file)
+        download_queue.extend(failed)
 
+        downloads: List[FileDownload] = []
         for file in download_queue:
-            file.create_path()
-
-            model_uri_file: Gio.File = Gio.File.new_for_uri(file.url)
-            model_file = Gio.File.new_for_path(file.path)
             try:
-                model_uri_file.copy(model_file,
-                                    Gio.FileCopyFlags.OVERWRITE,
-                                    _cancellable,
-                                    self._progress_cb)
-            except GLib.Error as err:
-                logging.error(err.message)
+                size, accepts_ranges = query_file(file.url)
+            except (OSError, HTTPException) as err:
+                logging.error("Querying %s failed: %s", file.url, err)
+                self.emit("failed", str(err))
                 return
 
-            self._current_download_size += file.get_size()
+            downloads.append(FileDownload(file, size, accepts_ranges))
+
+        self._total_download_size = sum(download.size or 0
+                                        for download in downloads)
+        self._current_download_size = sum(download.downloaded
+                                          for download in downloads)
+
+        if not self._download_all(downloads):
+            if self._cancelled is False:
+                self.emit("failed", self._error)
+            return
+
+        self._convert_weights()
+        self._prepare_model()
+
+        if self._cancelled is True:
+            return
 
         self.emit("finished")
 
-    def _progress_cb(self, current_num_bytes, _total_num_bytes):
-        curr = (self._current_download_size + current_num_bytes) / 1024 / 1024
-        total = self._total_download_size / 1024 / 1024
+    def _download_all(self, downloads: List[FileDownload]) -> bool:
+        # Start with the ranges of the big files, small files fill the
+        # remaining connections
+        downloads.sort(key=lambda download: download.size or 0, reverse=True)
+
+        for download in downloads:
+            download.open()
+
+        self._failed = False
+        self._error = ""
+
+        def is_cancelled() -> bool:
+            return self._cancelled or self._failed
+
+        with ThreadPoolExecutor(max_workers=MAX_CONNECTIONS) as executor:
+            futures = [executor.submit(download.download_range,
+                                       index,
+                                       is_cancelled,
+                                       self._progress_cb)
+                       for download in downloads
+                       for index in download.pending_ranges()]
+
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except DownloadCancelled:
+                    pass
+                except (OSError, HTTPException) as err:
+                    logging.error("Download failed: %s", err)
+                    self._error = str(err)
+                    self._failed = True
+
+        for download in downloads:
+            if download.pending_ranges():
+                download.close()
+                continue
+
+            try:
+                download.finish()
+            except OSError as err:
+                logging.error("Verifying download failed: %s", err)
+                self._error = str(err)
+                self._failed = True
+                continue
+
+            verification_cache.add(download.file.path, download.file.sha256)
+
+        verification_cache.save()
+
+        return not is_cancelled()
+
+    def _convert_weights(self) -> None:
+        weight_files = [(file.path, file.sha256, file.get_size())
+                        for file in self._files
+                        if file.exists() and get_safetensors_path(file.path)]
+
+        if not weight_files:
+            return
+
+        self.emit("convert")
+
+        if not inference_worker.run_job("weights_converter",
+                                        (weight_files,),
+                                        lambda _msg: None):
+            logging.warning("Converting weights to safetensors failed, "
+                            "keeping pickled weights")
+
+        for file in self._files:
+            if (converted := get_converted(file)) is not None:
+                verification_cache.add(converted["path"], converted["sha256"])
+
+        verification_cache.save()
+
+    def _prepare_model(self) -> None:
+        # Quantizing or exporting takes a while, better now than on the
+        # first generation
+        if not is_quantized_model_enabled() and get_inference_backend() == "pytorch":
+            return
+
+        self.emit("convert")
+
+        if not inference_worker.run_job("model_preparer",
+                                        (),
+                                        lambda _msg: None):
+            logging.warning("Preparing the model failed, it will be "
+                            "prepared on first use")
+
+    def _progress_cb(self, num_bytes: int) -> None:
+        with self._progress_lock:
+            self._current_download_size += num_bytes
+
+            curr = self._current_download_size // 1024 // 1024
+            total = self._total_download_size // 1024 // 1024
 
         self.emit("update",
                   curr,
                   total)
 
-    def start(self):
-        self._cancelled: bool = False
+    def start(self, files: List[File], deep_verify: bool = False) -> None:
+        """Verify files and download the missing or broken ones.
+
+        Files that did not change since they were last verified are not
+        hashed again, unless deep_verify is set.
+        """
+        self._files = files
+        self._deep_verify = deep_verify
+        self._cancelled = False
         self._task_cancellable.reset()
 
         self._task = Gio.Task.new(self,  # type: ignore
@@ -58,7 +58,7 @@ class File(GObject.Object):
 
     @sha256.setter
     def sha256(self, sha256: str) -> None:
-        self._path = sha256
+        self._sha256 = sha256
 
     def exists(self) -> bool:
         path: Path = Path(self.path)
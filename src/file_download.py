@@ -0,0 +1,268 @@
+# file_download.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import urllib.request
+from typing import Callable, List, Optional, Tuple
+
+from .file import File
+
+CHUNK_SIZE = 1024 * 1024
+READ_BACK_SIZE = 8 * 1024 * 1024
+TIMEOUT = 30
+
+# Files larger than this are fetched as several byte ranges in parallel
+SPLIT_THRESHOLD = 64 * 1024 * 1024
+MAX_RANGES = 4
+
+# Chunks between two writes of the resume state
+STATE_SAVE_INTERVAL = 16
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+class ChecksumMismatch(OSError):
+    pass
+
+
+def query_file(url: str) -> Tuple[Optional[int], bool]:
+    """Return the size of url and whether the server accepts range requests.
+
+    Asks for the first byte only. urllib follows redirects of a HEAD with
+    a GET of the whole file, a GET of one byte stays one byte.
+    """
+    request = urllib.request.Request(url, headers={"Range": "bytes=0-0"})
+
+    with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+        if response.status == 206:
+            # Content-Range: bytes 0-0/<size>
+            size = response.headers.get("Content-Range", "").rpartition("/")[2]
+
+            return (int(size) if size.isdigit() else None, True)
+
+        # The whole file is on its way, closing the response drops it
+        length = response.headers.get("Content-Length")
+
+        return (int(length) if length is not None else None, False)
+
+
+class FileDownload:  # pylint: disable=too-many-instance-attributes
+    """Resumable download of a single file.
+
+    Data is written into <path>.part, split into byte ranges that can be
+    fetched concurrently. How far every range got is kept in
+    <path>.part.json, so an interrupted download continues where it left
+    off. Without range support on the server, or without a known size, the
+    file is fetched as a single range from the start.
+
+    The sha256 is computed while the data arrives. Chunks that land right
+    at the end of the hashed prefix are hashed straight from memory, data
+    that arrived ahead of it is read back once the gap is closed, mostly
+    from the page cache.
+    """
+
+    def __init__(self,
+                 file: File,
+                 size: Optional[int],
+                 accepts_ranges: bool) -> None:
+        self.file = file
+        self.size = size
+
+        self._part_path = file.path + ".part"
+        self._state_path = file.path + ".part.json"
+        self._accepts_ranges = accepts_ranges and size is not None
+
+        self._lock = threading.Lock()
+        self._fd: Optional[int] = None
+        self._chunks_since_save = 0
+
+        self._hash_lock = threading.Lock()
+        self._sha256 = hashlib.sha256()
+        self._hashed = 0
+
+        # [start, end, downloaded] per range, end is None for unknown sizes
+        self._ranges: List[List] = self._load_state() or self._split()
+
+    def _split(self) -> List[List]:
+        if not self._accepts_ranges or not self.size:
+            return [[0, self.size, 0]]
+
+        n_ranges = max(1, min(MAX_RANGES, self.size // SPLIT_THRESHOLD))
+        range_size = (self.size + n_ranges - 1) // n_ranges
+
+        return [[start, min(start + range_size, self.size), 0]
+                for start in range(0, self.size, range_size)]
+
+    def _load_state(self) -> Optional[List[List]]:
+        if not self._accepts_ranges or not os.path.isfile(self._part_path):
+            return None
+
+        try:
+            with open(self._state_path, "r", encoding="utf-8") as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError):
+            return None
+
+        if state.get("url") != self.file.url or state.get("size") != self.size:
+            return None
+
+        return state["ranges"]
+
+    def _save_state(self) -> None:
+        tmp_path = self._state_path + ".tmp"
+
+        with open(tmp_path, "w", encoding="utf-8") as state_file:
+            json.dump({"url": self.file.url,
+                       "size": self.size,
+                       "ranges": self._ranges}, state_file)
+
+        os.replace(tmp_path, self._state_path)
+
+    @property
+    def downloaded(self) -> int:
+        return sum(downloaded for _start, _end, downloaded in self._ranges)
+
+    def _contiguous_end(self) -> int:
+        for start, end, downloaded in self._ranges:
+            if end is None or start + downloaded < end:
+                return start + downloaded
+
+        return self._ranges[-1][1]
+
+    def _hash(self, offset: int, data: bytes, blocking: bool = False) -> None:
+        # Whoever holds the lock also catches up on data other threads
+        # wrote meanwhile, so there is no need to wait for it
+        # pylint: disable-next=consider-using-with
+        if not self._hash_lock.acquire(blocking=blocking):
+            return
+
+        try:
+            if data and offset == self._hashed:
+                self._sha256.update(data)
+                self._hashed += len(data)
+
+            while True:
+                with self._lock:
+                    end = self._contiguous_end()
+
+                if self._hashed >= end:
+                    break
+
+                data = os.pread(self._fd,  # type: ignore
+                                min(READ_BACK_SIZE, end - self._hashed),
+                                self._hashed)
+                self._sha256.update(data)
+                self._hashed += len(data)
+        finally:
+            self._hash_lock.release()
+
+    def pending_ranges(self) -> List[int]:
+        return [index for index, (start, end, downloaded) in enumerate(self._ranges)
+                if end is None or start + downloaded < end]
+
+    def open(self) -> None:
+        self.file.create_path()
+
+        resume = self.downloaded > 0
+        self._fd = os.open(self._part_path, os.O_RDWR | os.O_CREAT)
+
+        if not resume:
+            os.ftruncate(self._fd, self.size or 0)
+            with self._lock:
+                self._save_state()
+
+    def download_range(self,
+                       index: int,
+                       is_cancelled: Callable[[], bool],
+                       progress_cb: Callable[[int], None]) -> None:
+        start, end, downloaded = self._ranges[index]
+
+        request = urllib.request.Request(self.file.url)
+        if self._accepts_ranges:
+            request.add_header("Range", f"bytes={start + downloaded}-{end - 1}")
+
+        with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+            if self._accepts_ranges and response.status != 206:
+                raise OSError(f"Server ignored range request for {self.file.url}")
+
+            while (data := response.read(CHUNK_SIZE)):
+                if is_cancelled():
+                    raise DownloadCancelled()
+
+                offset = start + downloaded
+                os.pwrite(self._fd, data, offset)  # type: ignore
+                downloaded += len(data)
+
+                with self._lock:
+                    self._ranges[index][2] = downloaded
+
+                    self._chunks_since_save += 1
+                    if self._chunks_since_save >= STATE_SAVE_INTERVAL:
+                        self._chunks_since_save = 0
+                        self._save_state()
+
+                self._hash(offset, data)
+
+                progress_cb(len(data))
+
+        if end is not None and start + downloaded < end:
+            raise OSError(f"Connection closed early while fetching {self.file.url}")
+
+        if end is None:
+            with self._lock:
+                self._ranges[index][1] = start + downloaded
+
+    def close(self) -> None:
+        if self._fd is None:
+            return
+
+        with self._lock:
+            self._save_state()
+
+        os.close(self._fd)
+        self._fd = None
+
+    def finish(self) -> None:
+        """Check the sha256 of the completed download and move it into place.
+
+        Raises ChecksumMismatch and removes the download if the digest does
+        not match, so the next attempt starts from scratch.
+        """
+        self._hash(0, b"", blocking=True)
+        sha256 = self._sha256.hexdigest()
+
+        os.fsync(self._fd)  # type: ignore
+        self.close()
+
+        if sha256 != self.file.sha256:
+            os.remove(self._part_path)
+            os.remove(self._state_path)
+            raise ChecksumMismatch(f"Checksum mismatch for {self.file.url}: "
+                                   f"expected {self.file.sha256}, got {sha256}")
+
+        os.replace(self._part_path, self.file.path)
+        os.remove(self._state_path)
+
+        logging.info("Downloaded %s", self.file.path)
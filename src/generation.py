@@ -0,0 +1,289 @@
+# generation.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import logging
+import math
+import os
+import random
+import time
+from contextlib import contextmanager
+from multiprocessing import connection
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import torch
+from diffusers import DiffusionPipeline
+from gi.repository import GLib
+
+from .batch_planner import AttentionMode, get_auto_budget, plan_micro_batches
+from .cpu_performance import autocast
+from .inference_worker import raise_if_cancelled
+from .preview_buffer import PREVIEW_MAX_SIZE, PreviewBuffer
+from .settings_manager import get_memory_budget
+
+# Linear approximation of the SD 1.5 VAE decoder, from the four latent
+# channels to RGB in [-1, 1]
+LATENT_RGB_FACTORS = [[0.298, 0.207, 0.208],
+                      [0.187, 0.286, 0.173],
+                      [-0.158, 0.189, 0.264],
+                      [-0.184, -0.271, -0.473]]
+
+
+def get_seeds(use_seed: bool, seed: int, n_images: int) -> List[int]:
+    """Return one seed per image.
+
+    Every image gets its own seed for its initial noise. With deterministic
+    schedulers, an image thus comes out the same no matter how the run is
+    split into micro-batches. Ancestral schedulers draw the noise of their
+    steps for a whole micro-batch, so with them it depends on the split.
+    """
+    if not use_seed:
+        seed = random.randrange(2 ** 32)
+
+    return [seed + i for i in range(n_images)]
+
+
+def get_device() -> str:
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def get_noise(seeds: List[int], shape: Tuple[int, ...]) -> torch.Tensor:
+    """Initial latents for every seed, drawn on the CPU for reproducibility."""
+    return torch.cat([torch.randn((1,) + shape,
+                                  generator=torch.Generator().manual_seed(seed))
+                      for seed in seeds])
+
+
+def get_generator(seed: int) -> torch.Generator:
+    return torch.Generator(device=get_device()).manual_seed(seed)
+
+
+def plan_batches(pipeline: DiffusionPipeline,
+                 n_images: int,
+                 height: int,
+                 width: int,
+                 guidance: bool) -> List[int]:
+    """Split a run into micro-batches that fit the memory budget.
+
+    Also switches attention slicing of the pipeline on or off as the plan
+    requires.
+    """
+    budget = get_memory_budget() * 1024 * 1024 or get_auto_budget()
+
+    batch_sizes, attention_mode = plan_micro_batches(n_images,
+                                                     height,
+                                                     width,
+                                                     budget,
+                                                     guidance)
+
+    if attention_mode == AttentionMode.SLICED:
+        pipeline.enable_attention_slicing()
+    else:
+        pipeline.disable_attention_slicing()
+
+    logging.info("Generating %d images in micro-batches of %s (%s attention)",
+                 n_images, batch_sizes, attention_mode.name.lower())
+
+    return batch_sizes
+
+
+def encode_prompt(pipeline: DiffusionPipeline,
+                  prompt: str,
+                  neg_prompt: str,
+                  guidance: bool) -> torch.Tensor:
+    """Encode the prompts once for a single image.
+
+    With guidance the result holds the negative prompt embeddings followed
+    by the prompt embeddings.
+    """
+    # pylint: disable-next=protected-access
+    return pipeline._encode_prompt(prompt, pipeline.device, 1, guidance,
+                                   neg_prompt)
+
+
+def repeat_embeddings(embeddings: torch.Tensor,
+                      batch_size: int,
+                      guidance: bool) -> torch.Tensor:
+    if not guidance:
+        return embeddings.repeat(batch_size, 1, 1)
+
+    uncond, cond = embeddings.chunk(2)
+
+    return torch.cat([uncond.repeat(batch_size, 1, 1),
+                      cond.repeat(batch_size, 1, 1)])
+
+
+# pylint: disable-next=too-many-arguments, too-many-locals
+def denoise(pipeline: DiffusionPipeline,
+            latents: torch.Tensor,
+            embeddings: torch.Tensor,
+            timesteps: torch.Tensor,
+            guidance_scale: float,
+            generator: torch.Generator,
+            callback: Callable[[int, int, torch.Tensor], None],
+            timer: "StageTimer") -> torch.Tensor:
+    """Run the denoising loop of the pipeline on a batch of latents.
+
+    The scheduler has to be set up for the run with set_timesteps before,
+    which also clears the state multistep schedulers keep between steps.
+    """
+    guidance = guidance_scale > 1.0
+    extra_step_kwargs = pipeline.prepare_extra_step_kwargs(generator, 0.0)
+
+    for i, timestep in enumerate(timesteps):
+        raise_if_cancelled()
+
+        with timer.stage("unet_step"), autocast(pipeline.device):
+            model_input = torch.cat([latents] * 2) if guidance else latents
+            model_input = pipeline.scheduler.scale_model_input(model_input,
+                                                               timestep)
+
+            noise_pred = pipeline.unet(model_input,
+                                       timestep,
+                                       encoder_hidden_states=embeddings).sample
+
+            if guidance:
+                noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+                noise_pred = noise_pred_uncond + guidance_scale * (
+                    noise_pred_text - noise_pred_uncond
+                )
+
+            latents = pipeline.scheduler.step(noise_pred,
+                                              timestep,
+                                              latents,
+                                              **extra_step_kwargs).prev_sample
+
+        callback(i, timestep, latents)
+
+    return latents
+
+
+# pylint: disable-next=too-many-arguments
+def save_images(pipeline: DiffusionPipeline,
+                latents: torch.Tensor,
+                first_index: int,
+                file_prefix: str,
+                image_cb: Callable[[int, str], None],
+                timer: "StageTimer") -> None:
+    """Decode and save the images of a batch one at a time.
+
+    image_cb gets the index and path of every image as soon as it has been
+    written, so it can be shown before the rest of the batch is decoded.
+    """
+    for i in range(latents.shape[0]):
+        raise_if_cancelled()
+
+        with timer.stage("vae_decode"), autocast(pipeline.device):
+            image = pipeline.decode_latents(latents[i:i + 1])
+
+        with timer.stage("safety_check"):
+            image, _has_nsfw = pipeline.run_safety_checker(image,
+                                                           pipeline.device,
+                                                           latents.dtype)
+
+        index = first_index + i
+        file_name = os.path.join(GLib.get_user_cache_dir(),
+                                 f"{file_prefix}_{index}.png")
+
+        with timer.stage("png_encode"):
+            pipeline.numpy_to_pil(image)[0].save(file_name)
+
+        image_cb(index, file_name)
+
+
+def latents_to_preview(latents: torch.Tensor) -> Tuple[bytes, int, int]:
+    """Approximate RGB pixels of the first latents of a batch.
+
+    Returns the pixels together with their width and height. One pixel per
+    latent pixel, downsampled to at most PREVIEW_MAX_SIZE on each side.
+    """
+    factors = torch.tensor(LATENT_RGB_FACTORS)
+    rgb = torch.einsum("chw,cr->hwr", latents[0].float().cpu(), factors)
+
+    stride = math.ceil(max(rgb.shape[0], rgb.shape[1]) / PREVIEW_MAX_SIZE)
+    rgb = rgb[::stride, ::stride]
+
+    rgb = ((rgb + 1) / 2).clamp(0, 1).mul(255).to(torch.uint8)
+
+    return rgb.contiguous().numpy().tobytes(), rgb.shape[1], rgb.shape[0]
+
+
+class StageTimer:
+    """Times the stages of a job and reports each one to the runner.
+
+    Every stage that completes is sent as a ("metrics", stage, seconds)
+    message, so the timings arrive while the job is still running. Stages
+    that raise, like a cancelled step, are not reported.
+    """
+
+    def __init__(self, child_connection: connection.Connection) -> None:
+        self._child_connection = child_connection
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+
+        yield
+
+        # CUDA kernels run asynchronously, wait for them so the time lands
+        # on the stage that queued them
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+        self._child_connection.send(("metrics",
+                                     name,
+                                     time.perf_counter() - start))
+
+
+class PreviewSender:
+    """Sends a preview of the latents every interval steps.
+
+    The pixels go through the shared memory block of the runner, only a
+    ("preview", width, height) message is sent over the pipe.
+    """
+
+    def __init__(self,
+                 child_connection: connection.Connection,
+                 interval: int,
+                 buffer_name: Optional[str]) -> None:
+        self._child_connection = child_connection
+        self._interval = interval
+        self._buffer: Optional[PreviewBuffer] = None
+
+        if interval > 0 and buffer_name is not None:
+            self._buffer = PreviewBuffer(buffer_name)
+
+    def send(self, step: int, latents: torch.Tensor) -> None:
+        if self._buffer is None or (step + 1) % self._interval:
+            return
+
+        data, width, height = latents_to_preview(latents)
+        self._buffer.write(data)
+
+        self._child_connection.send(("preview", width, height))
+
+    def close(self) -> None:
+        if self._buffer is not None:
+            self._buffer.close()
+            self._buffer = None
+
+    def __enter__(self) -> "PreviewSender":
+        return self
+
+    def __exit__(self, *_exc_info: object) -> None:
+        self.close()
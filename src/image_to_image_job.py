@@ -0,0 +1,184 @@
+# image_to_image_job.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import hashlib
+import uuid
+from multiprocessing import connection
+from typing import Optional
+
+import torch
+from diffusers import StableDiffusionImg2ImgPipeline as SDI2IPipeline
+from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion_img2img \
+    import preprocess
+from PIL import Image
+
+from .generation import (PreviewSender, StageTimer, denoise, encode_prompt,
+                         get_generator, get_noise, get_seeds, plan_batches,
+                         repeat_embeddings, save_images)
+from .model_registry import model_registry
+from .prompt_cache import prompt_cache
+from .tensor_cache import TensorCache
+
+# Scale of the SD 1.5 VAE latents
+VAE_SCALING_FACTOR = 0.18215
+
+HASH_BUFFER_SIZE = 1024 * 1024
+
+# A 512x512 image takes 64 KiB as latents, so this holds plenty of sources
+LATENT_CACHE_SIZE = 64 * 1024 * 1024
+
+# Init image latents by image content, kept for as long as the worker lives
+_latent_cache = TensorCache(LATENT_CACHE_SIZE)
+
+
+def _hash_file(path: str) -> str:
+    sha256 = hashlib.sha256()
+
+    with open(path, "rb") as file:
+        while (data := file.read(HASH_BUFFER_SIZE)):
+            sha256.update(data)
+
+    return sha256.hexdigest()
+
+
+def _encode_image(pipeline: SDI2IPipeline, image_path: str) -> torch.Tensor:
+    """VAE-encode the init image, reusing the latents of earlier runs.
+
+    The key is the file content, so the same image picked again under a
+    different path hits the cache, and an edited file misses it. Latents
+    of other model weights miss it as well.
+    """
+    key = (_hash_file(image_path),
+           model_registry.weights_key,
+           str(pipeline.device),
+           pipeline.vae.dtype)
+
+    latents = _latent_cache.get(key)
+    if latents is not None:
+        return latents
+
+    image = preprocess(Image.open(image_path).convert("RGB"))
+    image = image.to(device=pipeline.device, dtype=pipeline.vae.dtype)
+
+    latents = pipeline.vae.encode(image).latent_dist.mode() * VAE_SCALING_FACTOR
+    _latent_cache.put(key, latents)
+
+    return latents
+
+
+# pylint: disable-next=too-many-arguments, too-many-locals
+def run(child_connection: connection.Connection,
+        image_path: str,
+        prompt: str,
+        neg_prompt: str,
+        strength: float,
+        guidance_scale: float,
+        inf_steps: int,
+        use_seed: bool,
+        seed: int,
+        n_images: int,
+        preview_interval: int,
+        preview_buffer: Optional[str]) -> None:
+    timer = StageTimer(child_connection)
+
+    with timer.stage("model_load"):
+        pipeline = model_registry.get_pipeline(SDI2IPipeline)
+
+    device = pipeline.device
+    guidance = guidance_scale > 1.0
+
+    # Unique across runs and worker processes, so no image of an earlier
+    # run that is still shown or saved gets overwritten
+    file_prefix = f"i2i_image_{uuid.uuid4().hex}"
+
+    # The pipeline call would encode the init image and the prompt once
+    # per output image, so the loop is run here on the pipeline components
+    with torch.no_grad(), PreviewSender(child_connection,
+                                        preview_interval,
+                                        preview_buffer) as preview:
+        # One VAE pass and one text encoder pass for the whole run
+        with timer.stage("image_encoding"):
+            image_latents = _encode_image(pipeline, image_path)
+
+        with timer.stage("text_encoding"):
+            embeddings = encode_prompt(pipeline, prompt, neg_prompt, guidance)
+
+        seeds = get_seeds(use_seed, seed, n_images)
+        noise = get_noise(seeds, tuple(image_latents.shape[1:]))
+
+        batch_sizes = plan_batches(pipeline,
+                                   n_images,
+                                   image_latents.shape[2] * pipeline.vae_scale_factor,
+                                   image_latents.shape[3] * pipeline.vae_scale_factor,
+                                   guidance)
+
+        with timer.stage("scheduler_build"):
+            pipeline.scheduler.set_timesteps(inf_steps, device=device)
+            _timesteps, n_steps = pipeline.get_timesteps(inf_steps,
+                                                         strength,
+                                                         device)
+        total_steps = n_steps * len(batch_sizes)
+        step_offset = 0
+
+        def pipeline_cb(step: int,
+                        _timestep: int,
+                        latents: torch.FloatTensor) -> None:
+            child_connection.send(("update", step_offset + step, total_steps))
+            preview.send(step, latents)
+
+        def image_cb(index: int, path: str) -> None:
+            child_connection.send(("image", index, path))
+
+        image_index = 0
+        for batch_size in batch_sizes:
+            batch = slice(image_index, image_index + batch_size)
+
+            pipeline.scheduler.set_timesteps(inf_steps, device=device)
+            timesteps, _n_steps = pipeline.get_timesteps(inf_steps,
+                                                         strength,
+                                                         device)
+
+            # Every image starts from the same init latents with noise of
+            # its own seed added up to the first timestep
+            latents = pipeline.scheduler.add_noise(
+                image_latents.expand(batch_size, -1, -1, -1),
+                noise[batch].to(device=device, dtype=image_latents.dtype),
+                timesteps[:1].repeat(batch_size)
+            )
+
+            latents = denoise(pipeline,
+                              latents,
+                              repeat_embeddings(embeddings, batch_size, guidance),
+                              timesteps,
+                              guidance_scale,
+                              get_generator(seeds[batch][0]),
+                              pipeline_cb,
+                              timer)
+
+            save_images(pipeline,
+                        latents,
+                        image_index,
+                        file_prefix,
+                        image_cb,
+                        timer)
+
+            image_index += batch_size
+            step_offset += n_steps
+
+    prompt_cache.save()
@@ -0,0 +1,88 @@
+# inference_backend.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import importlib
+import logging
+from abc import ABC, abstractmethod
+from typing import Any, Dict
+
+import torch
+from diffusers import DiffusionPipeline
+
+# Setting value and module of every backend
+BACKEND_MODULES = {
+    "pytorch": "torch_backend",
+    "onnxruntime": "onnx_backend"
+}
+
+DEFAULT_BACKEND = "pytorch"
+
+
+def move_to_device(components: Dict[str, Any]) -> None:
+    if not torch.cuda.is_available():
+        return
+
+    for component in components.values():
+        if isinstance(component, torch.nn.Module):
+            component.to("cuda")
+
+
+class InferenceBackend(ABC):
+    """Runs the UNet, text encoder and VAE of the pipelines.
+
+    A backend loads the model components the pipelines are built from. It
+    may replace the UNet, text encoder and VAE with its own implementations,
+    as long as they can be called like the diffusers and transformers models
+    they stand in for. The scheduler, tokenizer and safety checker are
+    always the ones of diffusers and transformers.
+    """
+
+    @abstractmethod
+    def get_variant(self) -> str:
+        """Name of what load_components would load with the current settings.
+
+        The model registry reloads the components when this changes. Empty
+        for the plain PyTorch model.
+        """
+
+    @abstractmethod
+    def load_components(self, model_id: str) -> Dict[str, Any]:
+        """The components of model_id that the pipelines are built from."""
+
+    def prepare(self, pipeline: DiffusionPipeline) -> None:
+        """Called with the pipeline of every job before it runs."""
+
+
+def get_backend(name: str) -> InferenceBackend:
+    """The backend selected in the settings, PyTorch if it is not available.
+
+    Backends live in their own modules, so their runtimes are only
+    imported once they are used.
+    """
+    module_name = BACKEND_MODULES.get(name, BACKEND_MODULES[DEFAULT_BACKEND])
+
+    try:
+        module = importlib.import_module(f".{module_name}", __package__)
+    except ImportError as err:
+        logging.warning("Inference backend %s is not available, using %s: %s",
+                        name, DEFAULT_BACKEND, err)
+        module = importlib.import_module(f".{BACKEND_MODULES[DEFAULT_BACKEND]}",
+                                         __package__)
+
+    return module.backend
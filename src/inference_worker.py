@@ -0,0 +1,222 @@
+# inference_worker.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import importlib
+import logging
+import multiprocessing
+import threading
+import time
+from multiprocessing import connection
+from multiprocessing.context import SpawnProcess
+from multiprocessing.sharedctypes import Synchronized
+from typing import Callable, Optional, Tuple
+
+from .settings_manager import get_worker_idle_timeout
+
+# Jobs are started from the queue and download threads of the GUI, where
+# forking would copy whatever locks other threads hold
+_context = multiprocessing.get_context("spawn")
+
+# Job id of runs that can not be cancelled, queued jobs count up from 0
+NO_JOB = -1
+
+# Set in the worker process, the id of the running job and the shared id of
+# the job to stop
+_job_id = NO_JOB  # pylint: disable=invalid-name
+_cancelled_job: Optional[Synchronized] = None  # pylint: disable=invalid-name
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def raise_if_cancelled() -> None:
+    """Abort the running job if it has been cancelled.
+
+    Jobs call this between steps, so a cancelled job unwinds and frees its
+    tensors while the worker keeps the models loaded.
+    """
+    if (_job_id != NO_JOB
+            and _cancelled_job is not None
+            and _cancelled_job.value == _job_id):
+        raise JobCancelled()
+
+
+def _worker_main(child_connection: connection.Connection,
+                 cancelled_job: Synchronized,
+                 idle_timeout: int,
+                 spawn_time: float) -> None:
+    global _job_id, _cancelled_job  # pylint: disable=global-statement
+    _cancelled_job = cancelled_job
+
+    # Reported with the first job, the one that waited for the process
+    spawn_seconds: Optional[float] = time.time() - spawn_time
+
+    while child_connection.poll(idle_timeout):
+        try:
+            _job_id, job_name, job_args = child_connection.recv()
+        except EOFError:
+            return
+
+        if spawn_seconds is not None:
+            child_connection.send(("metrics", "process_spawn", spawn_seconds))
+            spawn_seconds = None
+
+        try:
+            # Jobs live in their own modules, so torch and diffusers are only
+            # ever imported in here and never in the GUI process.
+            job = importlib.import_module(f".{job_name}", __package__)
+            job.run(child_connection, *job_args)
+        except JobCancelled:
+            logging.info("Inference job cancelled")
+            child_connection.send(("cancelled",))
+        except Exception as error:  # pylint: disable=broad-except
+            logging.exception("Inference job failed")
+            child_connection.send(("error", str(error)))
+
+        child_connection.send('SENTINEL')
+
+    logging.info("Inference worker idle for %d s, unloading models", idle_timeout)
+
+
+class InferenceWorker:
+    """Long-lived child process that runs generation jobs.
+
+    The process is started on the first job and keeps the models loaded by
+    the model registry until it has been idle for the configured timeout.
+    If it exits, because it timed out, crashed or got terminated, the next
+    job starts a new one.
+
+    Cancelling a job shares its id with the worker. The job compares it to
+    its own between steps, so the worker and its models survive the
+    cancellation and a late cancel never hits the next job.
+    """
+
+    def __init__(self) -> None:
+        self._process: Optional[SpawnProcess] = None
+        self._connection: Optional[connection.Connection] = None
+        self._lock = threading.Lock()
+        # Guards the running job id against cancels from other threads
+        self._cancel_lock = threading.Lock()
+        self._cancelled_job = _context.Value("q", NO_JOB)
+        self._running_job = NO_JOB
+
+    def _ensure_running(self) -> None:
+        if self._process is not None and self._process.is_alive():
+            return
+
+        if self._process is not None:
+            if self._process.exitcode == 0:
+                logging.info("Restarting idle inference worker...")
+            else:
+                logging.warning("Inference worker exited with code %s, restarting...",
+                                self._process.exitcode)
+
+        if self._connection is not None:
+            self._connection.close()
+
+        self._connection, child_connection = _context.Pipe()
+
+        # The idle timeout is handed over, so the worker needs no settings
+        # until its first job
+        self._process = _context.Process(target=_worker_main,
+                                         args=(child_connection,
+                                               self._cancelled_job,
+                                               get_worker_idle_timeout(),
+                                               time.time()),
+                                         daemon=True)
+        self._process.start()
+
+        # Only the child keeps its end open, so we get an EOFError as soon
+        # as the worker goes away.
+        child_connection.close()
+
+    def run_job(self,
+                job_name: str,
+                job_args: Tuple,
+                message_cb: Callable[[Tuple], None],
+                is_cancelled: Callable[[], bool] = lambda: False,
+                job_id: int = NO_JOB) -> bool:
+        """Run the job module job_name in the worker and block until it is done.
+
+        Every message the job sends is passed to message_cb, a cancelled
+        job ends with ("cancelled",). Only jobs with a job_id can be
+        cancelled. Returns False if the worker went away before the job
+        finished or if is_cancelled is already true once it is the job's
+        turn.
+        """
+        with self._lock:
+            with self._cancel_lock:
+                self._running_job = job_id
+
+                # Checked after the job is marked as running, so a cancel
+                # either reaches the worker or is seen here
+                if is_cancelled():
+                    self._running_job = NO_JOB
+                    return False
+
+            try:
+                return self._run_job(job_id, job_name, job_args, message_cb)
+            finally:
+                with self._cancel_lock:
+                    self._running_job = NO_JOB
+
+    def _run_job(self,
+                 job_id: int,
+                 job_name: str,
+                 job_args: Tuple,
+                 message_cb: Callable[[Tuple], None]) -> bool:
+        # The worker might exit on its idle timeout right as we hand it a
+        # job, so retry once if it is gone before sending anything.
+        for _ in range(2):
+            self._ensure_running()
+
+            received = False
+            try:
+                self._connection.send((job_id, job_name, job_args))  # type: ignore
+
+                for msg in iter(self._connection.recv, 'SENTINEL'):  # type: ignore
+                    received = True
+                    message_cb(msg)
+
+                return True
+            except (EOFError, OSError) as error:
+                self._process.join()  # type: ignore
+
+                if received or self._process.exitcode != 0:  # type: ignore
+                    logging.info("Inference worker stopped during job: %s",
+                                 error)
+                    return False
+
+        return False
+
+    def cancel(self, job_id: int) -> None:
+        """Ask the worker to stop the job job_id if it is the one running."""
+        with self._cancel_lock:
+            if job_id != NO_JOB and self._running_job == job_id:
+                logging.info("Cancelling job %d...", job_id)
+                self._cancelled_job.value = job_id
+
+    def terminate(self) -> None:
+        if self._process is not None and self._process.is_alive():
+            logging.info("Terminating inference worker...")
+            self._process.terminate()
+
+
+inference_worker = InferenceWorker()
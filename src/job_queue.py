@@ -0,0 +1,292 @@
+# job_queue.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from enum import Enum
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from gi.repository import GLib, GObject
+
+from .inference_worker import inference_worker
+from .preview_buffer import PreviewBuffer
+from .settings_manager import get_preview_interval, is_metrics_log_enabled
+
+# Weight of the latest step in the smoothed step time
+STEP_SMOOTHING = 0.3
+
+METRICS_LOG_FILE = "metrics.jsonl"
+
+
+def remove_images(paths: Iterable[str]) -> None:
+    """Delete generated images once nothing shows or saves them anymore."""
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            logging.warning("Removing %s failed: %s", path, err)
+
+
+class JobState(Enum):
+    PENDING = 0
+    RUNNING = 1
+    FINISHED = 2
+    FAILED = 3
+    CANCELLED = 4
+
+
+class QueuedJob(GObject.Object):  # pylint: disable=too-many-instance-attributes
+    """A generation waiting in or taken from the job queue.
+
+    When the job starts, the queue appends the preview settings to
+    job_args. The signals are emitted from the queue thread, every job
+    ends with either "finished" or "cancelled", the latter also for jobs
+    that failed.
+
+    A running job stays RUNNING until the worker confirms it stopped, so a
+    cancel that comes too late leaves it FINISHED.
+
+    "metrics" carries the name and duration in seconds of every stage the
+    job completed, from spawning the worker to encoding the PNGs. They are
+    collected in metrics and, if enabled, appended to a JSON lines log once
+    the job is done.
+    """
+
+    __gsignals__ = {
+        "started": (GObject.SignalFlags.RUN_FIRST, None, ()),
+        "update": (GObject.SignalFlags.RUN_FIRST, None, (int, int,)),
+        "image-ready": (GObject.SignalFlags.RUN_FIRST, None, (int, str,)),
+        "preview": (GObject.SignalFlags.RUN_FIRST, None,
+                    (int, int, GObject.TYPE_PYOBJECT,)),
+        "metrics": (GObject.SignalFlags.RUN_FIRST, None, (str, float,)),
+        "cancelled": (GObject.SignalFlags.RUN_FIRST, None, ()),
+        "finished": (GObject.SignalFlags.RUN_FIRST, None, ())
+    }
+
+    _ids = itertools.count()
+
+    def __init__(self, job_name: str, job_args: Tuple, label: str) -> None:
+        super().__init__()
+
+        self.id: int = next(self._ids)  # pylint: disable=invalid-name
+        self.job_name = job_name
+        self.job_args = job_args
+        self.label = label
+
+        self.state = JobState.PENDING
+        self.cancel_requested = False
+        self.step = 0
+        self.total_steps = 0
+
+        self.metrics: Dict[str, List[float]] = {}
+        # Smoothed seconds per denoising step, None until the first step
+        self.step_seconds: Optional[float] = None
+
+        self._preview_buffer: Optional[PreviewBuffer] = None
+
+    def _on_message(self, msg: Tuple) -> None:
+        if msg[0] == "update":
+            self.step, self.total_steps = msg[1], msg[2]
+            self.emit("update", msg[1], msg[2])
+        elif msg[0] == "image":
+            self.emit("image-ready", msg[1], msg[2])
+        elif msg[0] == "preview" and self._preview_buffer is not None:
+            # RGB pixels of the given width and height
+            self.emit("preview",
+                      msg[1],
+                      msg[2],
+                      self._preview_buffer.read(msg[1] * msg[2] * 3))
+        elif msg[0] == "metrics":
+            self._add_metric(msg[1], msg[2])
+        elif msg[0] == "cancelled":
+            self.state = JobState.CANCELLED
+        elif msg[0] == "error":
+            logging.error("Job %d (%s) failed: %s", self.id, self.job_name, msg[1])
+            self.state = JobState.FAILED
+
+    def _add_metric(self, stage: str, seconds: float) -> None:
+        self.metrics.setdefault(stage, []).append(seconds)
+
+        if stage == "unet_step":
+            if self.step_seconds is None:
+                self.step_seconds = seconds
+            else:
+                self.step_seconds += STEP_SMOOTHING * (seconds - self.step_seconds)
+
+        self.emit("metrics", stage, seconds)
+
+    def _log_metrics(self) -> None:
+        entry = {"job_id": self.id,
+                 "job_name": self.job_name,
+                 "state": self.state.name.lower(),
+                 "time": time.time(),
+                 "stages": self.metrics}
+
+        path = os.path.join(GLib.get_user_cache_dir(), METRICS_LOG_FILE)
+
+        try:
+            with open(path, "a", encoding="utf-8") as log_file:
+                log_file.write(json.dumps(entry) + "\n")
+        except OSError as err:
+            logging.warning("Writing metrics log failed: %s", err)
+
+    def run(self) -> None:
+        self.emit("started")
+
+        job_args = self.job_args
+
+        preview_interval = get_preview_interval()
+        if preview_interval > 0:
+            self._preview_buffer = PreviewBuffer()
+            job_args += (preview_interval, self._preview_buffer.name)
+        else:
+            job_args += (0, None)
+
+        try:
+            completed = inference_worker.run_job(
+                self.job_name,
+                job_args,
+                self._on_message,
+                lambda: self.cancel_requested,
+                self.id
+            )
+        finally:
+            if self._preview_buffer is not None:
+                self._preview_buffer.close()
+                self._preview_buffer = None
+
+        if self.state == JobState.RUNNING:
+            if completed:
+                self.state = JobState.FINISHED
+            elif self.cancel_requested:
+                self.state = JobState.CANCELLED
+            else:
+                self.state = JobState.FAILED
+
+        if is_metrics_log_enabled():
+            self._log_metrics()
+
+        if self.state == JobState.FINISHED:
+            self.emit("finished")
+        else:
+            self.emit("cancelled")
+
+
+class JobQueue(GObject.Object):
+    """Runs queued generations one after another on the inference worker.
+
+    Pending jobs can be listed, reordered and cancelled while an earlier
+    job runs. "changed" is emitted whenever a job is added, moved, started
+    or removed, possibly from the queue thread.
+    """
+
+    __gsignals__ = {
+        "changed": (GObject.SignalFlags.RUN_FIRST, None, ())
+    }
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self._condition = threading.Condition()
+        self._pending: List[QueuedJob] = []
+        self._running: Optional[QueuedJob] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def jobs(self) -> List[QueuedJob]:
+        """The running job, if any, followed by the pending jobs in order."""
+        with self._condition:
+            running = [self._running] if self._running is not None else []
+            return running + list(self._pending)
+
+    def enqueue(self, job: QueuedJob) -> None:
+        with self._condition:
+            self._pending.append(job)
+            self._condition.notify()
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run_jobs,
+                                                daemon=True)
+                self._thread.start()
+
+        self.emit("changed")
+
+    def move(self, job: QueuedJob, position: int) -> None:
+        """Move a pending job to position among the pending jobs."""
+        with self._condition:
+            if job not in self._pending:
+                return
+
+            self._pending.remove(job)
+            self._pending.insert(max(0, position), job)
+
+        self.emit("changed")
+
+    def cancel(self, job: QueuedJob) -> None:
+        """Remove a pending job or ask the worker to stop the running one.
+
+        A running job emits "cancelled" once the worker stopped it.
+        """
+        with self._condition:
+            if job.state == JobState.PENDING:
+                job.state = JobState.CANCELLED
+                self._pending.remove(job)
+            elif job.state == JobState.RUNNING and not job.cancel_requested:
+                job.cancel_requested = True
+                inference_worker.cancel(job.id)
+                return
+            else:
+                return
+
+        job.emit("cancelled")
+        self.emit("changed")
+
+    def _run_jobs(self) -> None:
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+
+                self._running = self._pending.pop(0)
+                self._running.state = JobState.RUNNING
+
+            self.emit("changed")
+
+            job = self._running
+            try:
+                job.run()
+            except Exception:  # pylint: disable=broad-except
+                # The queue has to keep going for the jobs behind it
+                logging.exception("Running job %d failed", job.id)
+                job.state = JobState.FAILED
+                job.emit("cancelled")
+
+            with self._condition:
+                self._running = None
+
+            self.emit("changed")
+
+
+job_queue = JobQueue()
@@ -17,15 +17,18 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 # pylint: disable=wrong-import-position
+import json
 import logging
+import os
 import sys
+import time
 
 import gi
 
 gi.require_version('Gtk', '4.0')
 gi.require_version('Adw', '1')
 
-from gi.repository import Adw, Gio, Gtk
+from gi.repository import Adw, Gdk, Gio, GLib, Gtk
 
 from .mod import load_widgets
 from .preferences import Preferences
@@ -53,8 +56,29 @@ class ImageryApplication(Adw.Application):
         win = self.props.active_window
         if not win:
             win = ImageryWindow(application=self)
+            if "IMAGERY_STARTUP_BENCHMARK" in os.environ:
+                win.connect("map", self._report_startup_time)
         win.present()
 
+    def _report_startup_time(self, window: Gtk.Window) -> None:
+        """Print the time from launch until the first frame and quit.
+
+        Used by benchmarks/startup_time.py, which passes the launch time in
+        the IMAGERY_STARTUP_BENCHMARK environment variable.
+        """
+        launch_time = float(os.environ["IMAGERY_STARTUP_BENCHMARK"])
+        frame_clock = window.get_frame_clock()
+
+        def after_paint(_frame_clock: Gdk.FrameClock) -> None:
+            frame_clock.disconnect(handler_id)
+
+            print(json.dumps({"window_shown": time.time() - launch_time}),
+                  flush=True)
+
+            GLib.idle_add(self.quit)
+
+        handler_id = frame_clock.connect("after-paint", after_paint)
+
     def do_startup(self):  # pylint: disable=arguments-differ
         Adw.Application.do_startup(self)
 
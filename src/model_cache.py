@@ -0,0 +1,68 @@
+# model_cache.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import logging
+import os
+from typing import Any, Dict, List
+
+WEIGHT_EXTENSIONS = (".bin", ".safetensors")
+
+
+def get_source_key(model_id: str, components: List[str]) -> Dict[str, List[int]]:
+    """Size and mtime of the weight files of the given components.
+
+    Files derived from the weights, like quantized or exported models, are
+    stale once this changes.
+    """
+    sources: Dict[str, List[int]] = {}
+
+    for component in components:
+        component_dir = os.path.join(model_id, component)
+
+        for name in sorted(os.listdir(component_dir)):
+            if name.endswith(WEIGHT_EXTENSIONS):
+                stat = os.stat(os.path.join(component_dir, name))
+                sources[f"{component}/{name}"] = [stat.st_size, stat.st_mtime_ns]
+
+    return sources
+
+
+def is_cache_valid(manifest_path: str, key: Dict[str, Any]) -> bool:
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as manifest_file:
+            return json.load(manifest_file) == key
+    except (OSError, ValueError):
+        return False
+
+
+def save_cache_key(manifest_path: str, key: Dict[str, Any]) -> None:
+    """Record what a cache was made from.
+
+    Written after the cached files, so half-written ones never look valid.
+    """
+    tmp_path = manifest_path + ".tmp"
+
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as manifest_file:
+            json.dump(key, manifest_file, indent=2)
+
+        os.replace(tmp_path, manifest_path)
+    except OSError as err:
+        logging.warning("Saving %s failed: %s", manifest_path, err)
@@ -0,0 +1,31 @@
+# model_preparer.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from multiprocessing import connection
+
+from .model_registry import model_registry
+
+
+def run(_child_connection: connection.Connection) -> None:
+    """Make the variant of the model the settings select, if not cached yet.
+
+    Loading the model takes care of that and leaves it loaded in the worker
+    for the first generation.
+    """
+    model_registry.load()
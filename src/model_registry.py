@@ -0,0 +1,162 @@
+# model_registry.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import logging
+import os
+from typing import Any, Dict, Optional, Tuple, Type
+
+from diffusers import DiffusionPipeline
+from diffusers.pipelines.stable_diffusion.safety_checker import \
+    StableDiffusionSafetyChecker
+from transformers import CLIPFeatureExtractor
+
+from .inference_backend import InferenceBackend, get_backend, move_to_device
+from .model_files import get_model_family, sd15_folder
+from .prompt_cache import prompt_cache
+from .schedulers import build_scheduler
+from .settings_manager import get_inference_backend, is_nsfw_allowed
+
+
+class ModelRegistry:
+    """Holds a single copy of the model components in the inference worker.
+
+    Every pipeline handed out is built from the same UNet, VAE and text
+    encoder objects, so text-to-image and image-to-image share the weights.
+
+    The model is the one of the model family and the components come from
+    the inference backend selected in the settings. They are reloaded when
+    the family, the backend or its variant changes.
+    """
+
+    def __init__(self) -> None:
+        # Model the components were loaded from
+        self._model_id = ""
+        self._model_id_override: Optional[str] = None
+
+        self._components: Optional[Dict[str, Any]] = None
+        self._backend: Optional[InferenceBackend] = None
+        self._variant = ""
+        self._safety_components: Optional[Dict[str, Any]] = None
+        self._pipelines: Dict[Tuple[Type[DiffusionPipeline], bool],
+                              DiffusionPipeline] = {}
+
+    @property
+    def model_id(self) -> str:
+        return self._model_id_override or get_model_family().folder
+
+    @property
+    def weights_key(self) -> str:
+        """Names the loaded weights, for the caches of what they computed.
+
+        Backend variants give slightly different results, so they are part
+        of it.
+        """
+        return self._model_id + (f":{self._variant}" if self._variant else "")
+
+    def set_model_id(self, model_id: str) -> None:
+        """Use the model in model_id instead of the one of the family."""
+        self._model_id_override = model_id
+
+    def _get_components(self) -> Dict[str, Any]:
+        model_id = self.model_id
+        backend = get_backend(get_inference_backend())
+        variant = backend.get_variant()
+
+        if model_id != self._model_id:
+            self._components = None
+            self._safety_components = None
+            self._pipelines.clear()
+
+        changed = backend is not self._backend or variant != self._variant
+        if self._components is not None and changed:
+            self._components = None
+            self._pipelines.clear()
+
+        if self._components is None:
+            logging.info("Loading model components from %s (%s)",
+                         model_id, variant or "pytorch")
+
+            self._components = backend.load_components(model_id)
+            self._model_id = model_id
+            self._backend = backend
+            self._variant = variant
+
+            # Few-step models need the scheduler they were distilled for
+            scheduler = get_model_family().scheduler
+            if scheduler is not None:
+                self._components["scheduler"] = build_scheduler(
+                    scheduler,
+                    self._components["scheduler"].config
+                )
+
+            prompt_cache.install(self._components["text_encoder"],
+                                 self.weights_key)
+
+        return self._components
+
+    def load(self) -> None:
+        """Load the model components ahead of the first pipeline."""
+        self._get_components()
+
+    def _get_safety_components(self) -> Dict[str, Any]:
+        # Only loaded once generating NSFW images is disallowed
+        if self._safety_components is None:
+            # Families without a safety checker of their own share the one
+            # of SD 1.5
+            safety_id = self._model_id
+            if not os.path.isdir(os.path.join(safety_id, "safety_checker")):
+                safety_id = sd15_folder
+
+            logging.info("Loading safety checker from %s", safety_id)
+
+            self._safety_components = {
+                "safety_checker": StableDiffusionSafetyChecker.from_pretrained(
+                    os.path.join(safety_id, "safety_checker")
+                ),
+                "feature_extractor": CLIPFeatureExtractor.from_pretrained(
+                    os.path.join(safety_id, "feature_extractor")
+                )
+            }
+            move_to_device(self._safety_components)
+
+        return self._safety_components
+
+    def get_pipeline(self,
+                     pipeline_class: Type[DiffusionPipeline]) -> DiffusionPipeline:
+        nsfw_allowed = is_nsfw_allowed()
+        key = (pipeline_class, nsfw_allowed)
+
+        components = self._get_components()
+
+        if key not in self._pipelines:
+            components = dict(components)
+            if not nsfw_allowed:
+                components.update(self._get_safety_components())
+
+            self._pipelines[key] = pipeline_class(
+                **components,
+                requires_safety_checker=not nsfw_allowed
+            )
+
+        self._backend.prepare(self._pipelines[key])  # type: ignore
+
+        return self._pipelines[key]
+
+
+model_registry = ModelRegistry()
@@ -0,0 +1,316 @@
+# onnx_backend.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import importlib
+import json
+import logging
+import os
+import shutil
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+
+import onnxruntime
+import torch
+from diffusers import (AutoencoderKL, StableDiffusionPipeline,
+                       UNet2DConditionModel)
+from diffusers.configuration_utils import FrozenDict
+from gi.repository import GLib
+from transformers import CLIPTextConfig
+
+from .cpu_performance import get_physical_cores
+from .inference_backend import InferenceBackend
+from .model_cache import get_source_key, is_cache_valid, save_cache_key
+from .settings_manager import get_cpu_threads
+
+ONNX_OPSET = 14
+
+EXPORTED_COMPONENTS = ["text_encoder", "unet", "vae"]
+
+
+def get_onnx_dir(model_id: str) -> str:
+    return os.path.join(GLib.get_user_data_dir(),
+                        "onnx",
+                        os.path.basename(os.path.normpath(model_id)))
+
+
+def _get_cache_key(model_id: str) -> Dict[str, Any]:
+    return {"torch": torch.__version__,
+            "opset": ONNX_OPSET,
+            "sources": get_source_key(model_id, EXPORTED_COMPONENTS)}
+
+
+class _TextEncoderGraph(torch.nn.Module):
+    def __init__(self, text_encoder: torch.nn.Module) -> None:
+        super().__init__()
+        self.text_encoder = text_encoder
+
+    def forward(self, input_ids: torch.Tensor) -> torch.Tensor:
+        return self.text_encoder(input_ids)[0]
+
+
+class _UNetGraph(torch.nn.Module):
+    def __init__(self, unet: torch.nn.Module) -> None:
+        super().__init__()
+        self.unet = unet
+
+    def forward(self,
+                sample: torch.Tensor,
+                timestep: torch.Tensor,
+                encoder_hidden_states: torch.Tensor) -> torch.Tensor:
+        return self.unet(sample, timestep, encoder_hidden_states).sample
+
+
+class _VaeEncoderGraph(torch.nn.Module):
+    def __init__(self, vae: torch.nn.Module) -> None:
+        super().__init__()
+        self.vae = vae
+
+    def forward(self, sample: torch.Tensor) -> torch.Tensor:
+        return self.vae.encode(sample).latent_dist.mode()
+
+
+class _VaeDecoderGraph(torch.nn.Module):
+    def __init__(self, vae: torch.nn.Module) -> None:
+        super().__init__()
+        self.vae = vae
+
+    def forward(self, latent_sample: torch.Tensor) -> torch.Tensor:
+        return self.vae.decode(latent_sample).sample
+
+
+def _export_graph(module: torch.nn.Module,
+                  args: Tuple[torch.Tensor, ...],
+                  path: str,
+                  input_names: List[str],
+                  output_name: str) -> None:
+    # Every graph gets a directory of its own, torch writes the weights of
+    # graphs over 2 GB into separate files next to it
+    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+    os.makedirs(os.path.dirname(path))
+
+    # Batch size and image size may change from run to run
+    dynamic_axes = {name: {0: "batch", 2: "height", 3: "width"}
+                    if arg.dim() == 4 else {0: "batch"}
+                    for name, arg in zip(input_names, args)}
+    dynamic_axes[output_name] = dynamic_axes[input_names[0]]
+
+    torch.onnx.export(module,
+                      args,
+                      path,
+                      input_names=input_names,
+                      output_names=[output_name],
+                      dynamic_axes=dynamic_axes,
+                      opset_version=ONNX_OPSET,
+                      do_constant_folding=True)
+
+
+def _export(model_id: str, onnx_dir: str) -> None:
+    logging.info("Exporting %s to ONNX, this takes a while", model_id)
+
+    pipeline = StableDiffusionPipeline.from_pretrained(
+        model_id,
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False
+    )
+
+    unet_config = pipeline.unet.config
+    vae_config = pipeline.vae.config
+    max_length = pipeline.tokenizer.model_max_length
+    latent_shape = (unet_config.sample_size, unet_config.sample_size)
+    image_shape = tuple(size * pipeline.vae_scale_factor for size in latent_shape)
+
+    with torch.no_grad():
+        _export_graph(_TextEncoderGraph(pipeline.text_encoder),
+                      (torch.ones(1, max_length, dtype=torch.int64),),
+                      os.path.join(onnx_dir, "text_encoder", "model.onnx"),
+                      ["input_ids"],
+                      "last_hidden_state")
+
+        _export_graph(_UNetGraph(pipeline.unet),
+                      (torch.randn(2, unet_config.in_channels, *latent_shape),
+                       torch.ones(2),
+                       torch.randn(2, max_length, unet_config.cross_attention_dim)),
+                      os.path.join(onnx_dir, "unet", "model.onnx"),
+                      ["sample", "timestep", "encoder_hidden_states"],
+                      "out_sample")
+
+        _export_graph(_VaeEncoderGraph(pipeline.vae),
+                      (torch.randn(1, vae_config.in_channels, *image_shape),),
+                      os.path.join(onnx_dir, "vae_encoder", "model.onnx"),
+                      ["sample"],
+                      "latent_sample")
+
+        _export_graph(_VaeDecoderGraph(pipeline.vae),
+                      (torch.randn(1, vae_config.latent_channels, *latent_shape),),
+                      os.path.join(onnx_dir, "vae_decoder", "model.onnx"),
+                      ["latent_sample"],
+                      "sample")
+
+
+def _create_session(path: str) -> onnxruntime.InferenceSession:
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = get_cpu_threads() or get_physical_cores()
+    options.inter_op_num_threads = 1
+
+    return onnxruntime.InferenceSession(path,
+                                        sess_options=options,
+                                        providers=["CPUExecutionProvider"])
+
+
+class _OnnxModel:
+    """Base of the stand-ins for the torch models, running an exported graph."""
+
+    dtype = torch.float32
+    device = torch.device("cpu")
+
+    def __init__(self, onnx_dir: str, name: str, config: Any) -> None:
+        self.config = config
+
+        self._path = os.path.join(onnx_dir, name, "model.onnx")
+        self._session: Optional[onnxruntime.InferenceSession] = None
+
+    def run(self, **inputs: torch.Tensor) -> torch.Tensor:
+        # Sessions are created on first use, so the VAE encoder is only
+        # loaded for image-to-image
+        if self._session is None:
+            self._session = _create_session(self._path)
+
+        outputs = self._session.run(None, {name: value.cpu().numpy()
+                                           for name, value in inputs.items()})
+
+        return torch.from_numpy(outputs[0])
+
+
+class OnnxTextEncoder(_OnnxModel):
+    def __call__(self, *args: Any, **kwargs: Any) -> Tuple[torch.Tensor]:
+        # Through forward, so the prompt cache can wrap it
+        return self.forward(*args, **kwargs)
+
+    def forward(self,
+                input_ids: torch.Tensor,
+                attention_mask: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor]:
+        # The SD 1.5 text encoder does not use an attention mask
+        del attention_mask
+
+        return (self.run(input_ids=input_ids.long()),)
+
+
+class OnnxUNet(_OnnxModel):
+    @property
+    def in_channels(self) -> int:
+        return self.config.in_channels
+
+    def __call__(self,
+                 sample: torch.Tensor,
+                 timestep: Any,
+                 encoder_hidden_states: torch.Tensor) -> SimpleNamespace:
+        timesteps = torch.as_tensor(timestep, dtype=torch.float32).reshape(-1)
+
+        out_sample = self.run(sample=sample.float(),
+                              timestep=timesteps.expand(sample.shape[0]),
+                              encoder_hidden_states=encoder_hidden_states.float())
+
+        return SimpleNamespace(sample=out_sample)
+
+    def set_attention_slice(self, _slice_size: Any) -> None:
+        # ONNX Runtime plans the memory of the graph itself
+        pass
+
+
+class OnnxVae:
+    """Stand-in for the VAE, with a graph each for encoding and decoding."""
+
+    dtype = torch.float32
+    device = torch.device("cpu")
+
+    def __init__(self, onnx_dir: str, config: Any) -> None:
+        self.config = config
+
+        self._encoder = _OnnxModel(onnx_dir, "vae_encoder", config)
+        self._decoder = _OnnxModel(onnx_dir, "vae_decoder", config)
+
+    def encode(self, sample: torch.Tensor) -> SimpleNamespace:
+        latents = self._encoder.run(sample=sample.float())
+
+        return SimpleNamespace(latent_dist=SimpleNamespace(mode=lambda: latents))
+
+    def decode(self, latent_sample: torch.Tensor) -> SimpleNamespace:
+        sample = self._decoder.run(latent_sample=latent_sample.float())
+
+        return SimpleNamespace(sample=sample)
+
+
+def _load_from_index(model_id: str, name: str) -> Any:
+    """Load the component name with the class model_index.json names for it."""
+    with open(os.path.join(model_id, "model_index.json"), "r",
+              encoding="utf-8") as index_file:
+        library, class_name = json.load(index_file)[name]
+
+    component_class = getattr(importlib.import_module(library), class_name)
+
+    return component_class.from_pretrained(os.path.join(model_id, name))
+
+
+class OnnxBackend(InferenceBackend):
+    """Runs the UNet, text encoder and VAE in ONNX Runtime on the CPU.
+
+    The models are exported to ONNX once and kept under the user data dir
+    until the weights they were exported from change. ONNX Runtime applies
+    all its graph optimizations when it loads them.
+    """
+
+    def get_variant(self) -> str:
+        return "onnxruntime"
+
+    def load_components(self, model_id: str) -> Dict[str, Any]:
+        onnx_dir = get_onnx_dir(model_id)
+        manifest_path = os.path.join(onnx_dir, "exported.json")
+
+        key = _get_cache_key(model_id)
+        if not is_cache_valid(manifest_path, key):
+            _export(model_id, onnx_dir)
+            save_cache_key(manifest_path, key)
+
+        logging.info("Loading ONNX models from %s", onnx_dir)
+
+        return {
+            "tokenizer": _load_from_index(model_id, "tokenizer"),
+            "scheduler": _load_from_index(model_id, "scheduler"),
+            "text_encoder": OnnxTextEncoder(
+                onnx_dir,
+                "text_encoder",
+                CLIPTextConfig.from_pretrained(os.path.join(model_id, "text_encoder"))
+            ),
+            "unet": OnnxUNet(
+                onnx_dir,
+                "unet",
+                FrozenDict(UNet2DConditionModel.load_config(model_id, subfolder="unet"))
+            ),
+            "vae": OnnxVae(
+                onnx_dir,
+                FrozenDict(AutoencoderKL.load_config(model_id, subfolder="vae"))
+            ),
+            "safety_checker": None,
+            "feature_extractor": None
+        }
+
+
+backend = OnnxBackend()
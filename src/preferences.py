@@ -17,15 +17,41 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import importlib.util
 import os
+from gettext import gettext as i18n
 
-from gi.repository import Adw, Gio, GLib, Gtk
+from gi.repository import Adw, Gio, GLib, GObject, Gtk
+
+# Values of the model-family setting, in the order of their rows
+MODEL_FAMILIES = ["sd15"]
+
+# Values of the inference-backend setting, in the order of their rows
+INFERENCE_BACKENDS = ["pytorch", "onnxruntime"]
+
+# Module every backend needs besides torch
+BACKEND_RUNTIMES = {"onnxruntime": "onnxruntime"}
+
+
+def is_backend_available(backend: str) -> bool:
+    # Only looked up, importing runtimes is left to the inference worker
+    runtime = BACKEND_RUNTIMES.get(backend)
+
+    return runtime is None or importlib.util.find_spec(runtime) is not None
 
 
 @Gtk.Template(resource_path='/io/github/mpobaschnig/Imagery/ui/preferences.ui')
 class Preferences(Adw.PreferencesWindow):
     __gtype_name__ = "PreferencesDialog"
 
+    _memory_budget_spin_button: Gtk.SpinButton = Gtk.Template.Child()
+    _preview_interval_spin_button: Gtk.SpinButton = Gtk.Template.Child()
+    _model_family_row: Adw.ComboRow = Gtk.Template.Child()
+    _inference_backend_row: Adw.ComboRow = Gtk.Template.Child()
+    _cpu_bfloat16_row: Adw.ActionRow = Gtk.Template.Child()
+    _cpu_threads_row: Adw.ActionRow = Gtk.Template.Child()
+    _cpu_threads_spin_button: Gtk.SpinButton = Gtk.Template.Child()
+
     def __init__(self, window):
         super().__init__()
 
@@ -36,16 +62,93 @@ class Preferences(Adw.PreferencesWindow):
         settings = Gio.Settings.new("io.github.mpobaschnig.Imagery")
 
         allow_nsfw_action = settings.create_action("allow-nsfw")
+        deep_verify_action = settings.create_action("deep-verify")
+        persist_prompt_cache_action = settings.create_action(
+            "persist-prompt-cache"
+        )
+        log_metrics_action = settings.create_action("log-metrics")
+        cpu_performance_action = settings.create_action("cpu-performance")
+        cpu_bfloat16_action = settings.create_action("cpu-bfloat16")
+        quantized_model_action = settings.create_action("quantized-model")
+        compiled_model_action = settings.create_action("compiled-model")
 
         action_group.add_action(allow_nsfw_action)
+        action_group.add_action(deep_verify_action)
+        action_group.add_action(persist_prompt_cache_action)
+        action_group.add_action(log_metrics_action)
+        action_group.add_action(cpu_performance_action)
+        action_group.add_action(cpu_bfloat16_action)
+        action_group.add_action(quantized_model_action)
+        action_group.add_action(compiled_model_action)
 
         self.insert_action_group("prefs", action_group)
 
+        settings.bind("memory-budget",
+                      self._memory_budget_spin_button,
+                      "value",
+                      Gio.SettingsBindFlags.DEFAULT)
+        settings.bind("preview-interval",
+                      self._preview_interval_spin_button,
+                      "value",
+                      Gio.SettingsBindFlags.DEFAULT)
+        settings.bind("cpu-threads",
+                      self._cpu_threads_spin_button,
+                      "value",
+                      Gio.SettingsBindFlags.DEFAULT)
+
+        self._model_family_row.set_selected(
+            MODEL_FAMILIES.index(settings.get_string("model-family"))
+        )
+        self._model_family_row.connect(
+            "notify::selected",
+            lambda row, _pspec: settings.set_string(
+                "model-family",
+                MODEL_FAMILIES[row.get_selected()]
+            )
+        )
+
+        # The worker falls back to PyTorch for backends that are missing
+        backend = settings.get_string("inference-backend")
+        if not is_backend_available(backend):
+            backend = INFERENCE_BACKENDS[0]
+
+        self._inference_backend_row.set_selected(INFERENCE_BACKENDS.index(backend))
+        self._inference_backend_row.connect("notify::selected",
+                                            self._on_inference_backend_selected,
+                                            settings)
+
+        # Both only take effect in performance mode
+        for row in (self._cpu_bfloat16_row, self._cpu_threads_row):
+            settings.bind("cpu-performance",
+                          row,
+                          "sensitive",
+                          Gio.SettingsBindFlags.GET)
+
+    def _on_inference_backend_selected(self,
+                                       row: Adw.ComboRow,
+                                       _pspec: GObject.ParamSpec,
+                                       settings: Gio.Settings) -> None:
+        backend = INFERENCE_BACKENDS[row.get_selected()]
+
+        if not is_backend_available(backend):
+            self.add_toast(Adw.Toast.new(
+                i18n("This inference backend is not installed")
+            ))
+            # Notifies again, with a backend that is always there
+            row.set_selected(0)
+            return
+
+        settings.set_string("inference-backend", backend)
+
     @Gtk.Template.Callback()
     def _on_clear_image_cache_clicked(self, _button):
-        for i in range(12):
-            file_name = os.path.join(GLib.get_user_cache_dir(),
-                                     f"image_{i}.png")
-            file: Gio.File = Gio.File.new_for_path(file_name)
-            if file.query_exists(None):
-                file.trash(None)
+        cache_dir = GLib.get_user_cache_dir()
+
+        # Generated images start with the prefix of their page
+        for file_name in os.listdir(cache_dir):
+            if not file_name.startswith(("t2i_image_", "i2i_image_")):
+                continue
+
+            file: Gio.File = Gio.File.new_for_path(os.path.join(cache_dir,
+                                                                file_name))
+            file.trash(None)
@@ -0,0 +1,57 @@
+# preview_buffer.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from multiprocessing import shared_memory
+from typing import Optional
+
+# Longest side of a preview in pixels, larger previews are downsampled
+PREVIEW_MAX_SIZE = 128
+PREVIEW_BUFFER_SIZE = PREVIEW_MAX_SIZE * PREVIEW_MAX_SIZE * 3
+
+
+class PreviewBuffer:
+    """Shared memory block that carries RGB previews out of the worker.
+
+    The runner creates the block for a run and passes its name to the job,
+    which attaches to it and only sends the preview size over the pipe.
+    The worker writes a new preview only every few steps, long after the
+    runner copied the previous one out.
+    """
+
+    def __init__(self, name: Optional[str] = None) -> None:
+        self._owner = name is None
+        self._memory = shared_memory.SharedMemory(name=name,
+                                                  create=self._owner,
+                                                  size=PREVIEW_BUFFER_SIZE)
+
+    @property
+    def name(self) -> str:
+        return self._memory.name
+
+    def write(self, data: bytes) -> None:
+        self._memory.buf[:len(data)] = data  # type: ignore
+
+    def read(self, size: int) -> bytes:
+        return bytes(self._memory.buf[:size])  # type: ignore
+
+    def close(self) -> None:
+        self._memory.close()
+
+        if self._owner:
+            self._memory.unlink()
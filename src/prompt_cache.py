@@ -0,0 +1,116 @@
+# prompt_cache.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import logging
+import os
+from typing import Any, Optional, Tuple
+
+import torch
+from gi.repository import GLib
+
+from .settings_manager import is_prompt_cache_persistent
+from .tensor_cache import TensorCache
+
+# One SD 1.5 prompt embedding takes about 240 KiB
+PROMPT_CACHE_SIZE = 32 * 1024 * 1024
+
+
+class PromptCache:
+    """Caches text encoder outputs by their token ids.
+
+    diffusers 0.11.1 pipelines only take prompts as strings, so the cache
+    sits in front of the forward pass of the text encoder. The prompt and
+    the negative prompt are encoded in separate calls, so a fixed negative
+    prompt keeps hitting the cache while the prompt changes.
+
+    If enabled in the settings, the cache is saved to disk after every job
+    and survives restarts of the worker.
+    """
+
+    def __init__(self, path: str, max_bytes: int) -> None:
+        self._path = path
+        self._cache = TensorCache(max_bytes)
+        self._dirty = False
+        self._loaded = False
+
+    def _load(self) -> None:
+        self._loaded = True
+
+        if not is_prompt_cache_persistent() or not os.path.isfile(self._path):
+            return
+
+        try:
+            entries = torch.load(self._path, map_location="cpu", weights_only=True)
+        except Exception as err:  # pylint: disable=broad-except
+            logging.warning("Loading prompt cache failed: %s", err)
+            return
+
+        for key, embeddings in entries:
+            self._cache.put(key, embeddings)
+
+    def install(self, text_encoder: torch.nn.Module, model_id: str) -> None:
+        """Route the forward pass of text_encoder through the cache."""
+        if not self._loaded:
+            self._load()
+
+        forward = text_encoder.forward
+
+        def cached_forward(input_ids: torch.Tensor,
+                           attention_mask: Optional[torch.Tensor] = None,
+                           **kwargs: Any) -> Tuple[torch.Tensor]:
+            if attention_mask is not None or kwargs:
+                return forward(input_ids,
+                               attention_mask=attention_mask,
+                               **kwargs)
+
+            key = (model_id, tuple(input_ids.shape), *input_ids.flatten().tolist())
+
+            embeddings = self._cache.get(key)
+            if embeddings is None:
+                embeddings = forward(input_ids)[0]
+                self._cache.put(key, embeddings.cpu())
+                self._dirty = True
+            else:
+                embeddings = embeddings.to(input_ids.device)
+
+            # The pipelines only ever read the last hidden state
+            return (embeddings,)
+
+        text_encoder.forward = cached_forward
+
+    def save(self) -> None:
+        if not self._dirty or not is_prompt_cache_persistent():
+            return
+
+        tmp_path = self._path + ".tmp"
+
+        try:
+            torch.save(self._cache.items(), tmp_path)
+            os.replace(tmp_path, self._path)
+        except OSError as err:
+            logging.warning("Saving prompt cache failed: %s", err)
+            return
+
+        self._dirty = False
+
+
+prompt_cache = PromptCache(
+    os.path.join(GLib.get_user_cache_dir(), "prompt_embeddings.pt"),
+    PROMPT_CACHE_SIZE
+)
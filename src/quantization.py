@@ -0,0 +1,137 @@
+# quantization.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import logging
+import os
+from typing import Any, Dict, Optional, Set
+
+import torch
+from diffusers import UNet2DConditionModel
+from transformers import CLIPTextConfig, CLIPTextModel
+
+from .model_cache import get_source_key, is_cache_valid, save_cache_key
+
+# Components with int8 Linear layers, the VAE and safety checker stay as
+# they are
+QUANTIZED_COMPONENTS = ["unet", "text_encoder"]
+
+
+def get_quantized_dir(model_id: str) -> str:
+    """The int8 variant of a model is kept beside its folder."""
+    return os.path.normpath(model_id) + "-int8"
+
+
+def _get_manifest_path(model_id: str) -> str:
+    return os.path.join(get_quantized_dir(model_id), "quantized.json")
+
+
+def _get_weights_path(model_id: str, component: str) -> str:
+    return os.path.join(get_quantized_dir(model_id), f"{component}.pt")
+
+
+def _get_cache_key(model_id: str) -> Dict[str, Any]:
+    """What the cached weights were made from.
+
+    The packed int8 format depends on the torch version and the quantized
+    engine, the values on the fp32 weight files they were made from.
+    """
+    return {"torch": torch.__version__,
+            "engine": torch.backends.quantized.engine,
+            "sources": get_source_key(model_id, QUANTIZED_COMPONENTS)}
+
+
+def _get_linear_names(component: str, module: torch.nn.Module) -> Set[str]:
+    # In the UNet only the attention and feed-forward layers of the
+    # transformer blocks, where nearly all its matmuls are. The text
+    # encoder is made of those entirely.
+    return {name for name, submodule in module.named_modules()
+            if isinstance(submodule, torch.nn.Linear)
+            and (component != "unet" or ".transformer_blocks." in name)}
+
+
+def _quantize(component: str, module: torch.nn.Module) -> torch.nn.Module:
+    return torch.quantization.quantize_dynamic(
+        module,
+        _get_linear_names(component, module),
+        dtype=torch.qint8,
+        inplace=True
+    )
+
+
+def quantize_components(components: Dict[str, Any], model_id: str) -> None:
+    """Quantize the UNet and text encoder in place and cache the result."""
+    logging.info("Quantizing %s to int8", model_id)
+
+    for component in QUANTIZED_COMPONENTS:
+        _quantize(component, components[component])
+
+    os.makedirs(get_quantized_dir(model_id), exist_ok=True)
+
+    try:
+        for component in QUANTIZED_COMPONENTS:
+            path = _get_weights_path(model_id, component)
+
+            torch.save(components[component].state_dict(), path + ".tmp")
+            os.replace(path + ".tmp", path)
+    except OSError as err:
+        logging.warning("Saving quantized model failed: %s", err)
+        return
+
+    save_cache_key(_get_manifest_path(model_id), _get_cache_key(model_id))
+
+
+def _build_empty(model_id: str, component: str) -> torch.nn.Module:
+    if component == "unet":
+        return UNet2DConditionModel.from_config(
+            UNet2DConditionModel.load_config(model_id, subfolder="unet")
+        )
+
+    return CLIPTextModel(
+        CLIPTextConfig.from_pretrained(os.path.join(model_id, "text_encoder"))
+    )
+
+
+def load_quantized_components(model_id: str) -> Optional[Dict[str, Any]]:
+    """The cached int8 UNet and text encoder, None if there are none.
+
+    The fp32 weights are never read, the components are built from their
+    configs and get the int8 weights loaded into them.
+    """
+    try:
+        if not is_cache_valid(_get_manifest_path(model_id),
+                              _get_cache_key(model_id)):
+            return None
+    except OSError:
+        return None
+
+    logging.info("Loading int8 model from %s", get_quantized_dir(model_id))
+
+    components = {}
+
+    for component in QUANTIZED_COMPONENTS:
+        module = _quantize(component, _build_empty(model_id, component))
+
+        # Packed int8 weights can only be unpickled as a whole. The file is
+        # written by us next to the model, so it is as trusted as the
+        # model's own pickled weights.
+        module.load_state_dict(torch.load(_get_weights_path(model_id, component),
+                                          map_location="cpu"))
+        components[component] = module.eval()
+
+    return components
@@ -0,0 +1,77 @@
+# schedulers.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from typing import Any, Optional, Union
+
+import numpy
+import torch
+from diffusers import (DDIMScheduler, DDPMScheduler,
+                       DPMSolverMultistepScheduler,
+                       EulerAncestralDiscreteScheduler, EulerDiscreteScheduler,
+                       LMSDiscreteScheduler, PNDMScheduler)
+
+
+class TrailingEulerDiscreteScheduler(EulerDiscreteScheduler):
+    """Euler with its timesteps spaced back from the last training timestep.
+
+    Distilled few-step models like SD-Turbo are trained to start at the
+    noisiest timestep. The evenly spaced timesteps of EulerDiscreteScheduler
+    run from the last to the first training timestep, which leaves a single
+    step at timestep 0 and wastes the last of a few.
+    """
+
+    def set_timesteps(self,
+                      num_inference_steps: int,
+                      device: Optional[Union[str, torch.device]] = None) -> None:
+        # pylint: disable=attribute-defined-outside-init
+        self.num_inference_steps = num_inference_steps
+
+        train_timesteps = self.config.num_train_timesteps
+        timesteps = numpy.round(
+            train_timesteps
+            - numpy.arange(num_inference_steps) * train_timesteps / num_inference_steps
+        ) - 1
+
+        sigmas = numpy.array(((1 - self.alphas_cumprod) / self.alphas_cumprod) ** 0.5)
+        sigmas = numpy.interp(timesteps, numpy.arange(0, len(sigmas)), sigmas)
+        sigmas = numpy.concatenate([sigmas, [0.0]]).astype(numpy.float32)
+
+        self.sigmas = torch.from_numpy(sigmas).to(device=device)
+        self.timesteps = torch.from_numpy(timesteps.astype(numpy.float32)).to(
+            device=device
+        )
+
+
+# Schedulers by the names the pages use for them
+SCHEDULERS = {scheduler.__name__: scheduler
+              for scheduler in [DDIMScheduler,
+                                DDPMScheduler,
+                                DPMSolverMultistepScheduler,
+                                EulerAncestralDiscreteScheduler,
+                                EulerDiscreteScheduler,
+                                LMSDiscreteScheduler,
+                                PNDMScheduler,
+                                TrailingEulerDiscreteScheduler]}
+
+DEFAULT_SCHEDULER = "PNDMScheduler"
+
+
+def build_scheduler(name: str, config: Any) -> Any:
+    """The scheduler name with the config of the model's scheduler."""
+    return SCHEDULERS.get(name, SCHEDULERS[DEFAULT_SCHEDULER]).from_config(config)
@@ -32,3 +32,58 @@ def is_model_download_finished() -> bool:
 
 def set_model_download_finished(value: bool) -> bool:
     return settings.set_boolean("download-finished", value)
+
+
+def get_worker_idle_timeout() -> int:
+    return settings.get_int("worker-idle-timeout")
+
+
+def is_deep_verify_enabled() -> bool:
+    return settings.get_boolean("deep-verify")
+
+
+def is_prompt_cache_persistent() -> bool:
+    return settings.get_boolean("persist-prompt-cache")
+
+
+def get_preview_interval() -> int:
+    """Steps between two previews of a running generation, 0 for none."""
+    return settings.get_int("preview-interval")
+
+
+def get_memory_budget() -> int:
+    """Memory budget for a generation in MiB, 0 for automatic."""
+    return settings.get_int("memory-budget")
+
+
+def is_metrics_log_enabled() -> bool:
+    return settings.get_boolean("log-metrics")
+
+
+def is_cpu_performance_enabled() -> bool:
+    return settings.get_boolean("cpu-performance")
+
+
+def is_cpu_bfloat16_enabled() -> bool:
+    return settings.get_boolean("cpu-bfloat16")
+
+
+def get_cpu_threads() -> int:
+    """Threads used for inference on the CPU, 0 for one per physical core."""
+    return settings.get_int("cpu-threads")
+
+
+def is_quantized_model_enabled() -> bool:
+    return settings.get_boolean("quantized-model")
+
+
+def get_inference_backend() -> str:
+    return settings.get_string("inference-backend")
+
+
+def is_compiled_model_enabled() -> bool:
+    return settings.get_boolean("compiled-model")
+
+
+def get_model_family_name() -> str:
+    return settings.get_string("model-family")
@@ -22,9 +22,10 @@ from typing import Tuple
 
 from gi.repository import Adw, GLib, GObject, Gtk
 
-from .download_manager import DownloadManager
-from .model_files import sd15_files
-from .settings_manager import set_model_download_finished
+from .download_manager import DownloadManager, get_required_files
+from .model_files import get_model_family
+from .settings_manager import (is_deep_verify_enabled,
+                               set_model_download_finished)
 
 
 @Gtk.Template(resource_path='/io/github/mpobaschnig/Imagery/ui/start_page.ui')
@@ -42,19 +43,34 @@ class StartPage(Gtk.Box):
     _download_model_button: Gtk.Button = Gtk.Template.Child()
     _cancel_download_button: Gtk.Button = Gtk.Template.Child()
     _continue_button: Gtk.Button = Gtk.Template.Child()
+    _download_error_label: Gtk.Label = Gtk.Template.Child()
     _model_license_hint_label: Gtk.Label = Gtk.Template.Child()
 
     def __init__(self):
         super().__init__()
 
-        self._download_manager: DownloadManager = DownloadManager(sd15_files)
+        self._download_manager: DownloadManager = DownloadManager()
 
         self._download_manager.connect("update", self._update)
+        self._download_manager.connect("verify-progress", self._verify_progress)
+        self._download_manager.connect("convert", self._convert)
         self._download_manager.connect("cancelled", self._cancelled)
+        self._download_manager.connect("failed", self._failed)
         self._download_manager.connect("finished", self._finished)
 
         self._current_page: int = 0
 
+        self._set_license_hint()
+
+    def _set_license_hint(self) -> None:
+        family = get_model_family()
+
+        self._model_license_hint_label.set_label(
+            i18n('By downloading, you accept the <a href="{url}">{license}</a>.')
+            .format(url=GLib.markup_escape_text(family.license_url),
+                    license=GLib.markup_escape_text(family.license_name))
+        )
+
     def _update(self,
                 _download_manager: DownloadManager,
                 current_downloaded: int,
@@ -69,19 +85,58 @@ class StartPage(Gtk.Box):
 
         GLib.idle_add(update, (current_downloaded, total_download))
 
+    def _verify_progress(self,
+                         _download_manager: DownloadManager,
+                         fraction: float) -> None:
+        def verify_progress(fraction: float) -> None:
+            self._progress_bar.set_text(
+                i18n("Verifying files... {percent} %").format(
+                    percent=int(fraction * 100)
+                )
+            )
+            self._progress_bar.set_fraction(fraction)
+
+        GLib.idle_add(verify_progress, fraction)
+
+    def _convert(self, _download_manager: DownloadManager) -> None:
+        def convert(_data: None) -> None:
+            self._progress_bar.set_text(i18n("Converting model files..."))
+            self._progress_bar.pulse()
+
+        GLib.idle_add(convert, None)
+
     def _cancelled(self, _download_manager: DownloadManager) -> None:
-        self._progress_bar.set_visible(False)
-        self._download_model_button.set_visible(True)
-        self._cancel_download_button.set_visible(False)
-        self._model_license_hint_label.set_visible(True)
+        def cancelled(_data: None) -> None:
+            self._progress_bar.set_visible(False)
+            self._download_model_button.set_visible(True)
+            self._cancel_download_button.set_visible(False)
+            self._model_license_hint_label.set_visible(True)
+
+        GLib.idle_add(cancelled, None)
+
+    def _failed(self, _download_manager: DownloadManager, error: str) -> None:
+        def failed(error: str) -> None:
+            self._progress_bar.set_visible(False)
+            self._download_model_button.set_visible(True)
+            self._cancel_download_button.set_visible(False)
+            self._model_license_hint_label.set_visible(True)
+            self._download_error_label.set_label(
+                i18n("Download failed: {error}").format(error=error)
+            )
+            self._download_error_label.set_visible(True)
+
+        GLib.idle_add(failed, error)
 
     def _finished(self, _download_manager: DownloadManager) -> None:
-        self._progress_bar.set_fraction(100)
-        self._progress_bar.set_text(i18n("Download finished"))
-        self._continue_button.set_visible(True)
-        self._cancel_download_button.set_visible(False)
+        def finished(_data: None) -> None:
+            self._progress_bar.set_fraction(100)
+            self._progress_bar.set_text(i18n("Download finished"))
+            self._continue_button.set_visible(True)
+            self._cancel_download_button.set_visible(False)
+
+            set_model_download_finished(True)
 
-        set_model_download_finished(True)
+        GLib.idle_add(finished, None)
 
     @Gtk.Template.Callback()
     def _on_download_model_button_clicked(self, _button):
@@ -89,12 +144,14 @@ class StartPage(Gtk.Box):
         self._download_model_button.set_visible(False)
 
         self._model_license_hint_label.set_visible(False)
+        self._download_error_label.set_visible(False)
 
         self._progress_bar.set_text(i18n("Verifying files..."))
         self._progress_bar.set_fraction(0.0)
         self._progress_bar.set_visible(True)
 
-        self._download_manager.start()
+        self._download_manager.start(get_required_files(),
+                                     is_deep_verify_enabled())
 
     @Gtk.Template.Callback()
     def _on_cancel_download_button_clicked(self, _button):
@@ -132,5 +189,16 @@ class StartPage(Gtk.Box):
         if self._current_page < self._carousel.get_n_pages():
             self._next_button.set_visible(True)
 
+    def reset(self) -> None:
+        self._progress_bar.set_visible(False)
+        self._download_model_button.set_visible(True)
+        self._cancel_download_button.set_visible(False)
+        self._continue_button.set_visible(False)
+        self._download_error_label.set_visible(False)
+        self._model_license_hint_label.set_visible(True)
+        self._set_license_hint()
+
+        set_model_download_finished(False)
+
     def cleanup(self):
         self._download_manager.cancel()
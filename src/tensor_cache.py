@@ -0,0 +1,74 @@
+# tensor_cache.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import threading
+from collections import OrderedDict
+from typing import Hashable, List, Optional, Tuple
+
+import torch
+
+
+class TensorCache:
+    """Least recently used cache of tensors, limited by their total size."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, torch.Tensor]" = OrderedDict()
+        self._size = 0
+
+    @staticmethod
+    def _nbytes(tensor: torch.Tensor) -> int:
+        return tensor.element_size() * tensor.nelement()
+
+    def get(self, key: Hashable) -> Optional[torch.Tensor]:
+        with self._lock:
+            tensor = self._entries.get(key)
+            if tensor is not None:
+                self._entries.move_to_end(key)
+
+            return tensor
+
+    def put(self, key: Hashable, tensor: torch.Tensor) -> None:
+        nbytes = self._nbytes(tensor)
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= self._nbytes(old)
+
+            self._entries[key] = tensor
+            self._size += nbytes
+
+            while self._size > self.max_bytes:
+                _key, evicted = self._entries.popitem(last=False)
+                self._size -= self._nbytes(evicted)
+
+    def items(self) -> List[Tuple[Hashable, torch.Tensor]]:
+        """Entries from least to most recently used."""
+        with self._lock:
+            return list(self._entries.items())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
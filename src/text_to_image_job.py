@@ -0,0 +1,121 @@
+# text_to_image_job.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import uuid
+from multiprocessing import connection
+from typing import Optional
+
+import torch
+from diffusers import StableDiffusionPipeline
+
+from .generation import (PreviewSender, StageTimer, denoise, encode_prompt,
+                         get_generator, get_noise, get_seeds, plan_batches,
+                         repeat_embeddings, save_images)
+from .model_registry import model_registry
+from .prompt_cache import prompt_cache
+from .schedulers import build_scheduler
+
+
+# pylint: disable-next=too-many-arguments, too-many-locals
+def run(child_connection: connection.Connection,
+        scheduler: str,
+        prompt: str,
+        neg_prompt: str,
+        height: int,
+        width: int,
+        guidance_scale: float,
+        inf_steps: int,
+        use_seed: bool,
+        seed: int,
+        n_images: int,
+        preview_interval: int,
+        preview_buffer: Optional[str]) -> None:
+    timer = StageTimer(child_connection)
+
+    with timer.stage("model_load"):
+        pipeline = model_registry.get_pipeline(StableDiffusionPipeline)
+
+    device = pipeline.device
+    guidance = guidance_scale > 1.0
+
+    # Unique across runs and worker processes, so no image of an earlier
+    # run that is still shown or saved gets overwritten
+    file_prefix = f"t2i_image_{uuid.uuid4().hex}"
+
+    with timer.stage("scheduler_build"):
+        pipeline.scheduler = build_scheduler(scheduler, pipeline.scheduler.config)
+
+    # Run the loop on the pipeline components, so the prompt is encoded
+    # once for all micro-batches and every image is saved as soon as it
+    # has been decoded
+    with torch.no_grad(), PreviewSender(child_connection,
+                                        preview_interval,
+                                        preview_buffer) as preview:
+        with timer.stage("text_encoding"):
+            embeddings = encode_prompt(pipeline, prompt, neg_prompt, guidance)
+
+        seeds = get_seeds(use_seed, seed, n_images)
+        noise = get_noise(seeds, (pipeline.unet.in_channels,
+                                  height // pipeline.vae_scale_factor,
+                                  width // pipeline.vae_scale_factor))
+
+        batch_sizes = plan_batches(pipeline, n_images, height, width, guidance)
+        total_steps = inf_steps * len(batch_sizes)
+        step_offset = 0
+
+        def pipeline_cb(step: int,
+                        _timestep: int,
+                        latents: torch.FloatTensor) -> None:
+            child_connection.send(("update", step_offset + step, total_steps))
+            preview.send(step, latents)
+
+        def image_cb(index: int, path: str) -> None:
+            child_connection.send(("image", index, path))
+
+        image_index = 0
+        for batch_size in batch_sizes:
+            batch = slice(image_index, image_index + batch_size)
+
+            pipeline.scheduler.set_timesteps(inf_steps, device=device)
+
+            latents = noise[batch].to(device=device, dtype=embeddings.dtype)
+            latents = latents * pipeline.scheduler.init_noise_sigma
+
+            # The initial noise comes from the per-image seeds, the generator
+            # only drives the noise ancestral schedulers add on every step
+            latents = denoise(pipeline,
+                              latents,
+                              repeat_embeddings(embeddings, batch_size, guidance),
+                              pipeline.scheduler.timesteps,
+                              guidance_scale,
+                              get_generator(seeds[batch][0]),
+                              pipeline_cb,
+                              timer)
+
+            save_images(pipeline,
+                        latents,
+                        image_index,
+                        file_prefix,
+                        image_cb,
+                        timer)
+
+            image_index += batch_size
+            step_offset += inf_steps
+
+    prompt_cache.save()
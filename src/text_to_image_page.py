@@ -18,14 +18,15 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import logging
-import os
-import time
 from enum import Enum
 from gettext import gettext as i18n
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
-from gi.repository import Gio, GLib, Gtk, GObject
+from gi.repository import Adw, Gdk, Gio, GLib, Gtk, GObject
 
+from .job_queue import QueuedJob, job_queue, remove_images
+from .model_files import get_model_family
+from .settings_manager import settings
 from .text_to_image_runner import TextToImageRunner
 from .prompt_ideas import prompt_idea_categories
 
@@ -42,12 +43,14 @@ class TextToImagePage(Gtk.Box):
     _settings_menu_button: Gtk.MenuButton = Gtk.Template.Child()
     _flow_box: Gtk.FlowBox = Gtk.Template.Child()
     _generating_progress_bar: Gtk.ProgressBar = Gtk.Template.Child()
+    _preview_picture: Gtk.Picture = Gtk.Template.Child()
     _height_spin_button: Gtk.SpinButton = Gtk.Template.Child()
     _inference_steps_spin_button: Gtk.SpinButton = Gtk.Template.Child()
     _seed_switch: Gtk.Switch = Gtk.Template.Child()
     _seed_spin_button: Gtk.SpinButton = Gtk.Template.Child()
     _number_images_spin_button: Gtk.SpinButton = Gtk.Template.Child()
     _run_button: Gtk.Button = Gtk.Template.Child()
+    _scheduler_group: Adw.PreferencesGroup = Gtk.Template.Child()
     _radio_button_pndm: Gtk.CheckButton = Gtk.Template.Child()
     _radio_button_lms: Gtk.CheckButton = Gtk.Template.Child()
     _radio_button_ed: Gtk.CheckButton = Gtk.Template.Child()
@@ -64,6 +67,7 @@ class TextToImagePage(Gtk.Box):
     _prompt_text_view: Gtk.TextView = Gtk.Template.Child()
     _neg_prompt_text_view: Gtk.TextView = Gtk.Template.Child()
     _prompt_ideas_menu_button: Gtk.Button = Gtk.Template.Child()
+    _clear_images_button: Gtk.Button = Gtk.Template.Child()
 
     _flow_box_pictures: List[Gtk.Picture] = []
 
@@ -72,9 +76,9 @@ class TextToImagePage(Gtk.Box):
 
         self._text_to_image_runner: TextToImageRunner = TextToImageRunner()
 
-        self._text_to_image_runner.connect("update", self._update)
-        self._text_to_image_runner.connect("finished", self._finished)
-        self._text_to_image_runner.connect("cancelled", self._cancelled)
+        self._job: Optional[QueuedJob] = None
+        # Images shown in the flow box, removed again with their pictures
+        self._image_paths: List[str] = []
 
         self._prompt_text_view.get_buffer().connect(
             "changed", self._on_prompt_text_view_buffer_change_cb
@@ -89,47 +93,119 @@ class TextToImagePage(Gtk.Box):
 
         self._fill_prompt_box()
 
-        self.page_state: self.PageState = self.PageState.START
+        settings.connect("changed::model-family", self._on_model_family_changed)
+        self._apply_model_family()
 
-        self._t_previous: float = 0
+        self.page_state: self.PageState = self.PageState.START
 
-    def _update(self, _: TextToImageRunner, step: int) -> None:
-        t_now = time.time()
-        t_diff = t_now - self._t_previous
-        self._t_previous = t_now
+    def _on_model_family_changed(self, _settings, _key):
+        self._apply_model_family()
 
-        number_steps = int(self._inference_steps_spin_button.get_value())
+    def _apply_model_family(self) -> None:
+        family = get_model_family()
 
-        time_left = (number_steps - step) * t_diff
+        self._inference_steps_spin_button.set_value(family.steps)
 
-        minutes: int = int(time_left // 60)
-        seconds: int = int(time_left % 60)
+        # Few-step models bring their own scheduler
+        self._scheduler_group.set_sensitive(family.scheduler is None)
+        self._scheduler_group.set_description(
+            "" if family.scheduler is None
+            else i18n("{model} uses the scheduler it was distilled for.").format(
+                model=family.title
+            )
+        )
 
-        if minutes == 0:
-            text = i18n(f"~{seconds} s left...")
+    def _watch_job(self, job: QueuedJob) -> None:
+        job.connect("started", self._started)
+        job.connect("update", self._update)
+        job.connect("image-ready", self._image_ready)
+        job.connect("preview", self._preview)
+        job.connect("finished", self._finished)
+        job.connect("cancelled", self._cancelled)
+
+    def _started(self, job: QueuedJob) -> None:
+        def start(job: QueuedJob) -> None:
+            self._job = job
+            self.page_state = self.PageState.RUNNING
+
+        GLib.idle_add(start, job)
+
+    def _update(self, job: QueuedJob, step: int, number_steps: int) -> None:
+        # The step time is smoothed over the timings the job reports, so a
+        # single slow step does not throw the estimate off
+        if job.step_seconds is None:
+            text = i18n("Estimating time left...")
         else:
-            text = i18n(f"~{minutes} min {seconds} s left...")
+            time_left = (number_steps - step - 1) * job.step_seconds
 
-        def update(data: Tuple[str, int, int]) -> None:
-            text: str = data[0]
-            step: int = data[1]
-            number_steps: int = data[2]
+            minutes: int = int(time_left // 60)
+            seconds: int = int(time_left % 60)
+
+            if minutes == 0:
+                text = i18n(f"~{seconds} s left...")
+            else:
+                text = i18n(f"~{minutes} min {seconds} s left...")
+
+        def update(data: Tuple[QueuedJob, str, int, int]) -> None:
+            job: QueuedJob = data[0]
+            text: str = data[1]
+            step: int = data[2]
+            number_steps: int = data[3]
+
+            if job is not self._job:
+                return
 
             self._generating_progress_bar.set_text(text)
             self._generating_progress_bar.set_fraction(step / number_steps)
 
-        GLib.idle_add(update, (text, step, number_steps))
+        GLib.idle_add(update, (job, text, step, number_steps))
 
-    def _finished(self, _):
-        n_images = int(self._number_images_spin_button.get_value())
+    def _image_ready(self, _job: QueuedJob, _image_index: int, path: str) -> None:
+        def add_image(path: str) -> None:
+            # Images of every job are kept, in the order they arrive, until
+            # the user discards them
+            self._add_image(path)
+            self._flow_box_scrolled_window.set_visible(True)
+            self._clear_images_button.set_visible(True)
 
-        for i in range(n_images):
-            self._add_image(i)
+        GLib.idle_add(add_image, path)
 
-        self.page_state = self.PageState.FINISHED
+    def _preview(self,
+                 job: QueuedJob,
+                 width: int,
+                 height: int,
+                 data: bytes) -> None:
+        def show_preview(data: Tuple[QueuedJob, Gdk.Texture]) -> None:
+            job, texture = data
+            if job is not self._job or self.page_state != self.PageState.RUNNING:
+                return
 
-    def _cancelled(self, _):
-        self.page_state = self.PageState.START
+            self._preview_picture.set_paintable(texture)
+            self._preview_picture.set_visible(True)
+
+        texture = Gdk.MemoryTexture.new(width,
+                                        height,
+                                        Gdk.MemoryFormat.R8G8B8,
+                                        GLib.Bytes.new(data),
+                                        width * 3)
+
+        GLib.idle_add(show_preview, (job, texture))
+
+    def _finished(self, job: QueuedJob) -> None:
+        def finish(job: QueuedJob) -> None:
+            if job is self._job:
+                self.page_state = self.PageState.FINISHED
+
+        # Queued behind the images still waiting to be added
+        GLib.idle_add(finish, job)
+
+    def _cancelled(self, job: QueuedJob) -> None:
+        def cancel(job: QueuedJob) -> None:
+            if job is self._job:
+                self._job = None
+                self.page_state = self.PageState.START
+
+        GLib.idle_add(cancel, job)
 
     def _fill_prompt_box(self):
         def _append_text(button: Gtk.Button, text_view: Gtk.TextView) -> None:
@@ -195,26 +271,17 @@ class TextToImagePage(Gtk.Box):
     def page_state(self, new_page_state: PageState) -> None:
         self._page_state = new_page_state
 
-        if new_page_state in (self.PageState.START, self.PageState.RUNNING):
-            for i, _ in enumerate(self._flow_box_pictures):
-                self._flow_box.remove(self._flow_box_pictures[i])
-
-            self._flow_box_pictures.clear()
-
-        if new_page_state == self.PageState.FINISHED:
-            self._flow_box_scrolled_window.set_visible(True)
+        # Every state change ends the previews of the previous run
+        self._preview_picture.set_visible(False)
+        self._preview_picture.set_paintable(None)
 
         if new_page_state == self.PageState.RUNNING:
             self._spinner.set_spinning(True)
             self._spin_button.set_visible(True)
 
-            self._prompt_text_view.set_sensitive(False)
-            self._neg_prompt_text_view.set_sensitive(False)
-
-            self._run_button.set_visible(False)
+            # The inputs stay usable, so further runs can be queued
+            self._run_button.set_tooltip_text(i18n("Add to Queue"))
             self._cancel_run_button.set_visible(True)
-            self._settings_menu_button.set_sensitive(False)
-            self._prompt_ideas_menu_button.set_sensitive(False)
 
             self._generating_progress_bar.set_text(i18n("Estimating time left..."))
             self._generating_progress_bar.set_show_text(True)
@@ -224,18 +291,13 @@ class TextToImagePage(Gtk.Box):
             self._spin_button.set_visible(False)
             self._spinner.set_spinning(False)
 
-            self._prompt_text_view.set_sensitive(True)
-            self._neg_prompt_text_view.set_sensitive(True)
-
-            self._run_button.set_visible(True)
+            self._run_button.set_tooltip_text(i18n("Generate"))
             self._cancel_run_button.set_visible(False)
-            self._settings_menu_button.set_sensitive(True)
-            self._prompt_ideas_menu_button.set_sensitive(True)
 
             self._generating_progress_bar.set_visible(False)
 
-    def _add_image(self, image_index: int) -> Gtk.Overlay:  # noqa: E501, pylint: disable=too-many-statements
-        def image_button_clicked(button: Gtk.Button, image: int) -> None:
+    def _add_image(self, path: str) -> Gtk.Overlay:  # noqa: E501, pylint: disable=too-many-statements
+        def image_button_clicked(button: Gtk.Button, path: str) -> None:
             def response_cb(dialog: Gtk.FileChooserNative,
                             response: int,
                             user_data: tuple) -> None:
@@ -255,10 +317,7 @@ class TextToImagePage(Gtk.Box):
                     button_spinner.set_spinning(False)
 
                 dest_file: Gio.File = dialog.get_file()
-                curr_file: Gio.File = Gio.File.new_for_path(
-                    os.path.join(GLib.get_user_cache_dir(),
-                                 f"t2i_image_{image}.png")
-                )
+                curr_file: Gio.File = Gio.File.new_for_path(path)
 
                 button: Gtk.Button = user_data[0]
                 button_spinner: Gtk.Spinner = user_data[1]
@@ -295,13 +354,21 @@ class TextToImagePage(Gtk.Box):
 
         button_spinner: Gtk.Spinner = Gtk.Spinner()
 
-        button.connect("clicked", image_button_clicked, image_index)
+        button.connect("clicked", image_button_clicked, path)
+
+        discard_button = Gtk.Button()
+        discard_button.set_margin_top(6)
+        discard_button.set_margin_start(6)
+        discard_button.set_icon_name("window-close-symbolic")
+        discard_button.set_tooltip_text(i18n("Discard Image"))
+        discard_button.set_halign(Gtk.Align.START)
+        discard_button.set_valign(Gtk.Align.START)
+        discard_button.add_css_class("osd")
 
-        curr_file_name = os.path.join(GLib.get_user_cache_dir(),
-                                      f"t2i_image_{image_index}.png")
+        overlay.add_overlay(discard_button)
 
         img = Gtk.Picture()
-        img.set_filename(curr_file_name)
+        img.set_filename(path)
         img.add_css_class("card")
         img.set_content_fit(Gtk.ContentFit.SCALE_DOWN)
         img.set_halign(Gtk.Align.CENTER)
@@ -321,12 +388,40 @@ class TextToImagePage(Gtk.Box):
         flow_box_child.set_child(overlay)
         flow_box_child.set_halign(Gtk.Align.CENTER)
 
+        discard_button.connect("clicked",
+                               lambda _button: self._remove_image(flow_box_child,
+                                                                  path))
+
         self._flow_box_pictures.append(flow_box_child)
-        self._flow_box.insert(flow_box_child, image_index)
+        self._image_paths.append(path)
+        self._flow_box.insert(flow_box_child, -1)
+
+    def _remove_image(self, flow_box_child: Gtk.FlowBoxChild, path: str) -> None:
+        self._flow_box.remove(flow_box_child)
+        self._flow_box_pictures.remove(flow_box_child)
+
+        self._image_paths.remove(path)
+        remove_images([path])
+
+        if not self._image_paths:
+            self._flow_box_scrolled_window.set_visible(False)
+            self._clear_images_button.set_visible(False)
+
+    @Gtk.Template.Callback()
+    def _on_clear_images_button_clicked(self, _button):
+        for flow_box_child in self._flow_box_pictures:
+            self._flow_box.remove(flow_box_child)
+        self._flow_box_pictures.clear()
+
+        remove_images(self._image_paths)
+        self._image_paths.clear()
+
+        self._flow_box_scrolled_window.set_visible(False)
+        self._clear_images_button.set_visible(False)
 
     @Gtk.Template.Callback()
     def _on_run_button_clicked(self, _button):
-        scheduler = self._get_scheduler()
+        family = get_model_family()
         start, end = self._prompt_text_view.get_buffer().get_bounds()
         prompt = str(self._prompt_text_view.get_buffer().get_text(start, end, False))
         nstart, nend = self._neg_prompt_text_view.get_buffer().get_bounds()
@@ -340,22 +435,22 @@ class TextToImagePage(Gtk.Box):
         seed = int(self._seed_spin_button.get_value())
         n_images = int(self._number_images_spin_button.get_value())
 
-        self.page_state = self.PageState.RUNNING
-
-        self._t_previous = time.time()
-
-        self._text_to_image_runner.run(
-            scheduler,
+        job = self._text_to_image_runner.create_job(
+            family.scheduler or self._get_scheduler(),
             prompt,
             neg_prompt,
             height,
             width,
+            family.guidance_scale,
             inf_steps,
             use_seed,
             seed,
             n_images
         )
 
+        self._watch_job(job)
+        job_queue.enqueue(job)
+
     def _on_prompt_text_view_buffer_change_cb(self, buffer: Gtk.TextBuffer) -> None:
         start, end = buffer.get_bounds()
         if buffer.get_text(start, end, False):
@@ -365,8 +460,11 @@ class TextToImagePage(Gtk.Box):
 
     @Gtk.Template.Callback()
     def _on_cancel_run_button_clicked(self, _button):
-        self._text_to_image_runner.cancel()
-        self.page_state = self.PageState.START
+        if self._job is not None:
+            job_queue.cancel(self._job)
 
     def cleanup(self) -> None:
-        self._text_to_image_runner.cancel()
+        if self._job is not None:
+            job_queue.cancel(self._job)
+
+        remove_images(self._image_paths)
@@ -0,0 +1,80 @@
+# torch_backend.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from typing import Any, Dict
+
+import torch
+from diffusers import DiffusionPipeline, StableDiffusionPipeline
+
+from .compiled_graphs import install
+from .cpu_performance import configure
+from .inference_backend import InferenceBackend, move_to_device
+from .quantization import load_quantized_components, quantize_components
+from .settings_manager import is_quantized_model_enabled
+
+
+class TorchBackend(InferenceBackend):
+    """Runs the diffusers and transformers models in PyTorch.
+
+    On the CPU, the UNet and text encoder can be swapped for their int8
+    variant, which is made and cached on the first load that asks for it.
+    The float32 UNet and VAE decoder run as compiled graphs while that is
+    switched on.
+    """
+
+    def get_variant(self) -> str:
+        # Dynamic int8 kernels only exist for the CPU
+        if is_quantized_model_enabled() and not torch.cuda.is_available():
+            return "int8"
+
+        return ""
+
+    def load_components(self, model_id: str) -> Dict[str, Any]:
+        quantized = self.get_variant() == "int8"
+
+        cached = load_quantized_components(model_id) if quantized else None
+
+        pipeline = StableDiffusionPipeline.from_pretrained(
+            model_id,
+            safety_checker=None,
+            feature_extractor=None,
+            requires_safety_checker=False,
+            **(cached or {})
+        )
+
+        components = dict(pipeline.components)
+
+        if quantized and cached is None:
+            quantize_components(components, model_id)
+
+        move_to_device(components)
+
+        # Dynamic int8 layers keep their weights packed, out of reach of the
+        # weightless graph files
+        if not quantized:
+            install(model_id, components["unet"], components["vae"])
+
+        return components
+
+    def prepare(self, pipeline: DiffusionPipeline) -> None:
+        if not torch.cuda.is_available():
+            configure(pipeline)
+
+
+backend = TorchBackend()
@@ -0,0 +1,96 @@
+# verification_cache.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import logging
+import os
+import threading
+from typing import Dict
+
+from .model_files import sd15_folder
+
+
+class VerificationCache:
+    """Remembers which files were verified, keyed by their stat data.
+
+    A file whose size, mtime and inode are unchanged since its sha256 was
+    last checked is trusted without reading it again.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict] = self._load()
+
+    def _load(self) -> Dict[str, Dict]:
+        try:
+            with open(self._path, "r", encoding="utf-8") as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _stat(path: str) -> Dict:
+        stat = os.stat(path)
+
+        return {"size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "inode": stat.st_ino}
+
+    def is_verified(self, path: str, sha256: str) -> bool:
+        with self._lock:
+            entry = self._entries.get(path)
+
+        if entry is None or entry["sha256"] != sha256:
+            return False
+
+        try:
+            return entry["stat"] == self._stat(path)
+        except OSError:
+            return False
+
+    def add(self, path: str, sha256: str) -> None:
+        try:
+            stat = self._stat(path)
+        except OSError:
+            return
+
+        with self._lock:
+            self._entries[path] = {"sha256": sha256, "stat": stat}
+
+    def remove(self, path: str) -> None:
+        with self._lock:
+            self._entries.pop(path, None)
+
+    def save(self) -> None:
+        tmp_path = self._path + ".tmp"
+
+        with self._lock:
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as cache_file:
+                    json.dump(self._entries, cache_file, indent=2)
+
+                os.replace(tmp_path, self._path)
+            except OSError as err:
+                logging.warning("Saving verification cache failed: %s", err)
+
+
+verification_cache = VerificationCache(
+    os.path.normpath(sd15_folder) + ".verified.json"
+)
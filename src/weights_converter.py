@@ -0,0 +1,102 @@
+# weights_converter.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import hashlib
+import logging
+import os
+from multiprocessing import connection
+from typing import Dict, List, Set, Tuple
+
+import torch
+
+from .converted_weights import (get_safetensors_path, load_manifest,
+                                save_manifest)
+
+
+def _sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as open_file:
+        while (data := open_file.read(1024 * 1024)):
+            sha256.update(data)
+
+    return sha256.hexdigest()
+
+
+def _to_safetensors_dict(
+        state_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+    # safetensors refuses tensors that share memory, so give every
+    # duplicate its own copy
+    seen: Set[int] = set()
+    tensors: Dict[str, torch.Tensor] = {}
+
+    for name, tensor in state_dict.items():
+        if tensor.data_ptr() in seen:
+            tensor = tensor.clone()
+        seen.add(tensor.data_ptr())
+
+        tensors[name] = tensor.contiguous()
+
+    return tensors
+
+
+def run(child_connection: connection.Connection,
+        weight_files: List[Tuple[str, str, int]]) -> None:
+    """Write safetensors versions of pickled weight files.
+
+    weight_files holds the path, verified sha256 and size of every pickled
+    file. The pickled file is removed once its converted version has been
+    recorded in the manifest.
+    """
+    try:
+        # pylint: disable-next=import-outside-toplevel
+        from safetensors.torch import save_file
+    except ImportError:
+        logging.warning("safetensors is not available, keeping pickled weights")
+        return
+
+    manifest = load_manifest()
+
+    for index, (source_path, source_sha256, source_size) in enumerate(weight_files):
+        target_path = get_safetensors_path(source_path)
+        if target_path is None:
+            continue
+
+        logging.info("Converting %s to safetensors", source_path)
+
+        state_dict = torch.load(source_path, map_location="cpu")
+
+        tmp_path = target_path + ".tmp"
+        save_file(_to_safetensors_dict(state_dict),
+                  tmp_path,
+                  metadata={"format": "pt"})
+        del state_dict
+
+        sha256 = _sha256(tmp_path)
+        os.replace(tmp_path, target_path)
+
+        manifest[target_path] = {
+            "source_sha256": source_sha256,
+            "source_size": source_size,
+            "sha256": sha256
+        }
+        save_manifest(manifest)
+
+        os.remove(source_path)
+
+        child_connection.send(("update", index + 1))
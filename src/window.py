@@ -17,12 +17,19 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import threading
 from enum import Enum
 from gettext import gettext as i18n
+from typing import List, Tuple
 
-from gi.repository import Adw, Gio, Gtk
+from gi.repository import Adw, Gio, GLib, Gtk, Pango
 
-from .settings_manager import is_model_download_finished
+from .download_manager import get_missing_files
+from .inference_worker import inference_worker
+from .job_queue import JobState, QueuedJob, job_queue
+from .settings_manager import (is_compiled_model_enabled,
+                               is_model_download_finished,
+                               set_model_download_finished, settings)
 
 
 @Gtk.Template(resource_path='/io/github/mpobaschnig/Imagery/ui/window.ui')
@@ -35,7 +42,8 @@ class ImageryWindow(Adw.ApplicationWindow):
     __gtype_name__ = 'ImageryWindow'
 
     _header_bar: Gtk.HeaderBar = Gtk.Template.Child()
-    _settings_menu_button: Gtk.MenuButton = Gtk.Template.Child()
+    _queue_menu_button: Gtk.MenuButton = Gtk.Template.Child()
+    _queue_list_box: Gtk.ListBox = Gtk.Template.Child()
     _stack: Gtk.Stack = Gtk.Template.Child()
     _menu_button_page: Gtk.MenuButton = Gtk.Template.Child()
     _page_state: PageState = PageState.START
@@ -48,21 +56,145 @@ class ImageryWindow(Adw.ApplicationWindow):
         self.create_action('text_to_image', self._on_text_to_image_clicked)
         self.create_action('image_to_image', self._on_image_to_image_clicked)
 
-        if is_model_download_finished():
+        self._stack.get_child_by_name("start").connect("finished",
+                                                       self._start_finished)
+
+        settings.connect("changed::allow-nsfw", self._on_required_files_changed)
+        settings.connect("changed::model-family", self._on_required_files_changed)
+        settings.connect("changed::compiled-model",
+                         self._on_compiled_model_changed)
+
+        self._queue_handlers: List[Tuple[QueuedJob, int]] = []
+        job_queue.connect("changed", self._on_job_queue_changed)
+
+        if is_model_download_finished() and not get_missing_files():
             self._header_bar.remove_css_class("flat")
-            self._settings_menu_button.set_visible(True)
+            self._queue_menu_button.set_visible(True)
             self.page_state = self.PageState.TEXT_TO_IMAGE
+            self._warm_up_compiled_model()
             return
 
-        self._stack.get_child_by_name("start").connect("finished",
-                                                       self._start_finished)
         self.page_state = self.PageState.START
 
     def _start_finished(self, _object):
         self._header_bar.remove_css_class("flat")
-        self._settings_menu_button.set_visible(True)
+        self._queue_menu_button.set_visible(True)
         self._menu_button_page.set_visible(True)
         self.page_state = self.PageState.TEXT_TO_IMAGE
+        self._warm_up_compiled_model()
+
+    def _on_required_files_changed(self, _settings, _key):
+        # Disallowing NSFW images needs the safety checker, which is not
+        # downloaded while they are allowed, and every model family has
+        # files of its own
+        start_page = self._stack.get_child_by_name("start")
+
+        if self.page_state == self.PageState.START:
+            # A running download is for the files required before
+            start_page.cleanup()
+            start_page.reset()
+
+            if not get_missing_files():
+                set_model_download_finished(True)
+                self._start_finished(start_page)
+            return
+
+        if not get_missing_files():
+            return
+
+        self._header_bar.add_css_class("flat")
+        self._queue_menu_button.set_visible(False)
+        start_page.reset()
+        self.page_state = self.PageState.START
+
+    def _on_compiled_model_changed(self, _settings, _key):
+        if self.page_state != self.PageState.START:
+            self._warm_up_compiled_model()
+
+    def _warm_up_compiled_model(self) -> None:
+        # Loading or compiling the graphs takes a while, better in the
+        # background now than on the first generation
+        if not is_compiled_model_enabled():
+            return
+
+        threading.Thread(target=inference_worker.run_job,
+                         args=("compiled_model_warm_up", (), lambda _msg: None),
+                         daemon=True).start()
+
+    def _on_job_queue_changed(self, _job_queue):
+        GLib.idle_add(self._fill_queue_list)
+
+    def _fill_queue_list(self) -> None:
+        for job, handler_id in self._queue_handlers:
+            job.disconnect(handler_id)
+        self._queue_handlers.clear()
+
+        while (row := self._queue_list_box.get_row_at_index(0)) is not None:
+            self._queue_list_box.remove(row)
+
+        jobs = job_queue.jobs
+        pending = [job for job in jobs if job.state == JobState.PENDING]
+
+        for job in jobs:
+            self._queue_list_box.append(self._create_queue_row(job, pending))
+
+    def _create_queue_row(self,
+                          job: QueuedJob,
+                          pending: List[QueuedJob]) -> Gtk.ListBoxRow:
+        def update(_job: QueuedJob, step: int, number_steps: int) -> None:
+            GLib.idle_add(progress_bar.set_fraction, step / number_steps)
+
+        def move_up(_button: Gtk.Button) -> None:
+            job_queue.move(job, pending.index(job) - 1)
+
+        def cancel(_button: Gtk.Button) -> None:
+            job_queue.cancel(job)
+
+        box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
+        box.set_margin_top(6)
+        box.set_margin_bottom(6)
+        box.set_margin_start(6)
+        box.set_margin_end(6)
+
+        info_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+        info_box.set_hexpand(True)
+        info_box.set_valign(Gtk.Align.CENTER)
+
+        label = Gtk.Label(label=job.label)
+        label.set_halign(Gtk.Align.START)
+        label.set_ellipsize(Pango.EllipsizeMode.END)
+        info_box.append(label)
+
+        progress_bar = Gtk.ProgressBar()
+        if job.state == JobState.RUNNING:
+            if job.total_steps:
+                progress_bar.set_fraction(job.step / job.total_steps)
+            self._queue_handlers.append((job, job.connect("update", update)))
+        else:
+            progress_bar.set_visible(False)
+        info_box.append(progress_bar)
+
+        box.append(info_box)
+
+        move_up_button = Gtk.Button(icon_name="go-up-symbolic")
+        move_up_button.set_tooltip_text(i18n("Run Earlier"))
+        move_up_button.set_valign(Gtk.Align.CENTER)
+        move_up_button.add_css_class("flat")
+        move_up_button.set_sensitive(job in pending and pending.index(job) > 0)
+        move_up_button.connect("clicked", move_up)
+        box.append(move_up_button)
+
+        cancel_button = Gtk.Button(icon_name="window-close-symbolic")
+        cancel_button.set_tooltip_text(i18n("Cancel"))
+        cancel_button.set_valign(Gtk.Align.CENTER)
+        cancel_button.add_css_class("flat")
+        cancel_button.connect("clicked", cancel)
+        box.append(cancel_button)
+
+        row = Gtk.ListBoxRow()
+        row.set_child(box)
+
+        return row
 
     def create_action(self, name, callback, _shortcuts=None):
         action = Gio.SimpleAction.new(name, None)
@@ -86,6 +218,7 @@ class ImageryWindow(Adw.ApplicationWindow):
         self._page_state = new_page_state
 
         if new_page_state == self.PageState.START:
+            stack.set_visible_child_name("start")
             self._menu_button_page.set_visible(False)
         elif new_page_state == self.PageState.TEXT_TO_IMAGE:
             stack.set_visible_child_name("text_to_image")
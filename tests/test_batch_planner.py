@@ -0,0 +1,78 @@
+# test_batch_planner.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import unittest
+
+from src.batch_planner import (AttentionMode, estimate_peak_bytes,
+                               plan_micro_batches)
+
+SIZE = 512
+
+
+class PlanMicroBatchesTest(unittest.TestCase):
+
+    def _budget(self, batch_size: int, guidance: bool = True) -> int:
+        return estimate_peak_bytes(SIZE, SIZE, batch_size, AttentionMode.DEFAULT,
+                                   guidance)
+
+    def test_no_images_need_no_batches(self) -> None:
+        batch_sizes, _attention_mode = plan_micro_batches(0, SIZE, SIZE,
+                                                          self._budget(4))
+
+        self.assertEqual(batch_sizes, [])
+
+    def test_fitting_run_is_a_single_batch(self) -> None:
+        self.assertEqual(plan_micro_batches(4, SIZE, SIZE, self._budget(4)),
+                         ([4], AttentionMode.DEFAULT))
+
+    def test_images_are_spread_evenly(self) -> None:
+        batch_sizes, _attention_mode = plan_micro_batches(7, SIZE, SIZE,
+                                                          self._budget(4))
+
+        self.assertEqual(batch_sizes, [4, 3])
+
+        batch_sizes, _attention_mode = plan_micro_batches(9, SIZE, SIZE,
+                                                          self._budget(4))
+
+        self.assertEqual(batch_sizes, [3, 3, 3])
+
+    def test_without_guidance_batches_are_larger(self) -> None:
+        budget = self._budget(2)
+
+        self.assertEqual(plan_micro_batches(4, SIZE, SIZE, budget)[0], [2, 2])
+        self.assertEqual(plan_micro_batches(4, SIZE, SIZE, budget, False)[0], [4])
+
+    def test_slices_attention_before_giving_up(self) -> None:
+        batch_sizes, attention_mode = plan_micro_batches(1, SIZE, SIZE,
+                                                         self._budget(1) - 1)
+
+        self.assertEqual(attention_mode, AttentionMode.SLICED)
+        self.assertEqual(batch_sizes, [1])
+
+    def test_decode_does_not_grow_with_the_batch(self) -> None:
+        # With sliced attention the decode of a single image is the peak
+        # for small batches, and images are decoded one at a time
+        self.assertEqual(
+            estimate_peak_bytes(SIZE, SIZE, 2, AttentionMode.SLICED),
+            estimate_peak_bytes(SIZE, SIZE, 1, AttentionMode.SLICED)
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
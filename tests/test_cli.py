@@ -0,0 +1,52 @@
+# test_cli.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import unittest
+from typing import Any, List
+
+from src.cli import InvalidRequest, _check_request
+
+
+class CheckRequestTest(unittest.TestCase):
+
+    def test_accepts_what_the_pages_allow(self) -> None:
+        _check_request({"prompt": "a lighthouse", "n_images": 4, "seed": 42})
+        _check_request({"prompt": "a lighthouse", "guidance_scale": 7})
+
+    def test_rejects_invalid_requests(self) -> None:
+        requests: List[Any] = [[],
+                               {},
+                               {"prompt": " "},
+                               {"prompt": 1},
+                               {"prompt": "a", "n_images": 0},
+                               {"prompt": "a", "n_images": True},
+                               {"prompt": "a", "steps": "25"},
+                               {"prompt": "a", "strength": 1.5},
+                               {"prompt": "a", "height": 500},
+                               {"prompt": "a", "scheduler": "LCMScheduler"},
+                               {"prompt": "a", "image": "missing.png"},
+                               {"prompt": "a", "n_image": 2}]
+
+        for request in requests:
+            with self.subTest(request=request), self.assertRaises(InvalidRequest):
+                _check_request(request)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,204 @@
+# test_file_download.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import hashlib
+import os
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, List, Optional, cast
+from unittest import mock
+
+from src import file_download
+from src.file import File
+from src.file_download import (ChecksumMismatch, DownloadCancelled,
+                               FileDownload, query_file)
+
+DATA = os.urandom(100_000)
+SHA256 = hashlib.sha256(DATA).hexdigest()
+
+
+class _Server(ThreadingHTTPServer):
+    """Serves DATA, with byte ranges unless accepts_ranges is unset.
+
+    /redirect redirects to /model.bin. The Range header of every GET of
+    DATA is recorded in ranges.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), _Handler)
+
+        self.accepts_ranges = True
+        self.ranges: List[Optional[str]] = []
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *_args: Any) -> None:  # pylint: disable=arguments-differ
+        pass
+
+    def _send_headers(self,
+                      status: int,
+                      length: int,
+                      content_range: Optional[str] = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        if cast(_Server, self.server).accepts_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if content_range is not None:
+            self.send_header("Content-Range", content_range)
+        self.end_headers()
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        server = cast(_Server, self.server)
+
+        if self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/model.bin")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        requested = self.headers.get("Range")
+        server.ranges.append(requested)
+
+        if requested is not None and server.accepts_ranges:
+            start, end = requested[len("bytes="):].split("-")
+            body = DATA[int(start):int(end) + 1]
+            self._send_headers(206,
+                               len(body),
+                               f"bytes {start}-{end}/{len(DATA)}")
+        else:
+            body = DATA
+            self._send_headers(200, len(body))
+
+        self.wfile.write(body)
+
+
+class FileDownloadTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self._dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self._dir.cleanup)
+
+        self._server = _Server()
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.addCleanup(self._server.server_close)
+        self.addCleanup(self._server.shutdown)
+
+        self._url = f"http://127.0.0.1:{self._server.server_port}/model.bin"
+        self._path = os.path.join(self._dir.name, "model.bin")
+
+        # Several ranges of several chunks each for the small test file
+        for name, value in (("SPLIT_THRESHOLD", 20_000),
+                            ("CHUNK_SIZE", 4096),
+                            ("STATE_SAVE_INTERVAL", 2)):
+            patcher = mock.patch.object(file_download, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _create_download(self, sha256: str = SHA256) -> FileDownload:
+        size, accepts_ranges = query_file(self._url)
+
+        return FileDownload(File(self._url, self._path, sha256),
+                            size,
+                            accepts_ranges)
+
+    @staticmethod
+    def _download(download: FileDownload,
+                  is_cancelled: Callable[[], bool] = lambda: False) -> None:
+        download.open()
+
+        try:
+            for index in download.pending_ranges():
+                download.download_range(index, is_cancelled, lambda _size: None)
+        finally:
+            if download.pending_ranges():
+                download.close()
+
+    def test_resumes_to_the_same_sha256(self) -> None:
+        chunks: List[int] = []
+
+        def cancel_after_some_chunks() -> bool:
+            chunks.append(1)
+            return len(chunks) > 5
+
+        download = self._create_download()
+        self.assertGreater(len(download.pending_ranges()), 1)
+
+        with self.assertRaises(DownloadCancelled):
+            self._download(download, cancel_after_some_chunks)
+
+        self.assertTrue(os.path.exists(self._path + ".part.json"))
+
+        resumed = self._create_download()
+        self.assertGreater(resumed.downloaded, 0)
+        self.assertLess(resumed.downloaded, len(DATA))
+
+        self._server.ranges.clear()
+        self._download(resumed)
+        resumed.finish()
+
+        # Only the missing bytes were fetched again
+        self.assertNotIn("bytes=0-", "".join(map(str, self._server.ranges)))
+
+        with open(self._path, "rb") as downloaded_file:
+            self.assertEqual(hashlib.sha256(downloaded_file.read()).hexdigest(),
+                             SHA256)
+        self.assertFalse(os.path.exists(self._path + ".part"))
+        self.assertFalse(os.path.exists(self._path + ".part.json"))
+
+    def test_falls_back_to_one_range_without_range_support(self) -> None:
+        self._server.accepts_ranges = False
+
+        download = self._create_download()
+        self.assertEqual(download.pending_ranges(), [0])
+
+        self._server.ranges.clear()
+        self._download(download)
+        download.finish()
+
+        self.assertEqual(self._server.ranges, [None])
+        with open(self._path, "rb") as downloaded_file:
+            self.assertEqual(downloaded_file.read(), DATA)
+
+    def test_query_follows_redirects_with_one_byte(self) -> None:
+        url = f"http://127.0.0.1:{self._server.server_port}/redirect"
+
+        self.assertEqual(query_file(url), (len(DATA), True))
+
+        # The redirected request did not turn into a GET of the whole file
+        self.assertEqual(self._server.ranges, ["bytes=0-0"])
+
+    def test_mismatch_removes_the_partial_download(self) -> None:
+        download = self._create_download(sha256="0" * 64)
+
+        self._download(download)
+
+        with self.assertRaises(ChecksumMismatch):
+            download.finish()
+
+        self.assertFalse(os.path.exists(self._path))
+        self.assertFalse(os.path.exists(self._path + ".part"))
+        self.assertFalse(os.path.exists(self._path + ".part.json"))
+
+
+if __name__ == "__main__":
+    unittest.main()
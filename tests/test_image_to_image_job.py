@@ -0,0 +1,99 @@
+# test_image_to_image_job.py
+#
+# Copyright 2023 Martin Pobaschnig
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import importlib.util
+import os
+import tempfile
+import unittest
+from typing import Any, List
+from unittest import mock
+
+from benchmarks import generation
+
+HAS_TORCH = all(importlib.util.find_spec(name) is not None
+                for name in ("torch", "diffusers", "transformers"))
+
+
+@unittest.skipUnless(HAS_TORCH, "needs torch, diffusers and transformers")
+class ImageToImageScalingTest(unittest.TestCase):
+    """The UNet work of a run grows linearly with the number of images.
+
+    Runs the job on the tiny benchmark model and counts the latents the
+    UNet is called on, which n copies of the init image with
+    num_images_per_prompt=n made grow with n².
+    """
+
+    _dir: tempfile.TemporaryDirectory
+    _model_dir: str
+    _environ: Any
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls._dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        cls._model_dir = os.path.join(cls._dir.name, "model")
+
+        generation.build_tiny_model(cls._model_dir)
+
+        # Read when the package is imported, so set up first
+        cls._environ = mock.patch.dict(
+            os.environ,
+            generation.prepare_environment(cls._dir.name, gpu=False)
+        )
+        cls._environ.start()
+
+        generation.load_package(os.path.join(generation.REPO_DIR, "src"))
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls._environ.stop()
+        cls._dir.cleanup()
+
+    def _count_unet_latents(self, n_images: int) -> int:
+        # pylint: disable-next=import-outside-toplevel
+        from diffusers import UNet2DConditionModel
+
+        latents: List[int] = []
+        forward = UNet2DConditionModel.forward
+
+        def counting_forward(unet: Any, sample: Any, *args: Any, **kwargs: Any) -> Any:
+            latents.append(sample.shape[0])
+            return forward(unet, sample, *args, **kwargs)
+
+        case = {"mode": "image_to_image",
+                "size": 64,
+                "steps": 8,
+                "n_images": n_images}
+
+        with mock.patch.object(UNet2DConditionModel, "forward", counting_forward):
+            result = generation.run_case(case, self._model_dir, self._dir.name)
+
+        self.assertEqual(len(result["images"]), n_images)
+
+        return sum(latents)
+
+    def test_unet_work_is_linear_in_the_number_of_images(self) -> None:
+        single = self._count_unet_latents(1)
+
+        self.assertGreater(single, 0)
+        for n_images in (2, 4):
+            self.assertEqual(self._count_unet_latents(n_images), n_images * single)
+
+
+if __name__ == "__main__":
+    unittest.main()